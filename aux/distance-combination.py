@@ -11,65 +11,124 @@ infiles:
 output:
 	For each run in 'distances.txt' calculate the distance
 	between trigger points, specified in 'combinations.txt'
+	<run> <trigger A> <trigger B> <distance>
+
+	With --fitlog print ratios of MPL for each combination
+	(like `fit_coeff.py FITLOG -c`).
 """
 import sys
 import os
-
-
-cfile = open('combinations.txt', 'ro')
-dfile = open('distances.txt', 'ro')
+import argparse
+import numpy as np
 
 DELIM = '\t'
 MISSING = '-'
 
-# the first line in 'distances.txt' is a header with the names of points.
 
-points = next(dfile)[:-1].upper().split(DELIM)[1:]
-#print 'POINTS:', points
+def load_points(dfile):
+	""" Read coordinates of points for each run.
+	The first line in 'distances.txt' is a header with the names of points.
+	Return (runs, points, values[run, point]), NaN for missing values.
+	"""
+	points = next(dfile).rstrip('\n').upper().split(DELIM)[1:]
+	runs = []
+	values = []
+
+	for lineno, dline in enumerate(dfile, 2):
+		if dline[0] == '#' or not dline.strip():
+			continue
+		dsplit = dline.rstrip('\n').split(DELIM)
+
+		if len(points) != len(dsplit) - 1:
+			sys.stderr.write("wrong number of values"
+				" in line {}: {}\n".format(lineno, dline))
+			exit(1)
 
-clines = [line for line in cfile]
+		runs.append(dsplit[0])
+		values.append([float(v) if v != MISSING else np.nan for v in dsplit[1:]])
 
-for dline in dfile:
-	if dline[0] == '#':
-		continue
-	dline = dline[:-1]  # strip \n
-	dsplit = dline.split(DELIM)
-	
-	run = dsplit[0]
+	return runs, points, np.array(values, dtype=float).reshape(len(runs), len(points))
 
-	values = [float(v) if v != MISSING else None for v in dsplit[1:] ]
 
-	if len(points) != len(values):
-		sys.stdout.write("wrong number of values"
-			" in line: {}\n".format(line))
-		exit(1)
-	
-	points_values = dict(zip(points, values))
-	
-	for cline in clines:
-		cline = cline[:-1]  # strip \n
-		cline = '\t'.join(cline.split())  #replace spaces with tabs if any
+def load_pairs(cfile, points):
+	""" Read combinations of triggers, each trigger is two points,
+	the combination should have one common point.
+	Return ([(A, B), ...], indices of the points for A, for B).
+	"""
+	pidx = dict((p, i) for i, p in enumerate(points))
+	pairs, idxA, idxB = [], [], []
 
-		A, B = cline.split(DELIM)
-		
+	for cline in cfile:
+		cline = cline.split()
+		if not cline or cline[0][0] == '#':
+			continue
+
+		A, B = cline
 		tA, tB = A.upper(), B.upper()
 
 		if tA[0] == tB[0]:  # the same first letter
-			vA = points_values[tA[1]]
-			vB = points_values[tB[1]]
+			pA, pB = tA[1], tB[1]
 
 		elif tA[1] == tB[1]:
-			vA = points_values[tA[0]]
-			vB = points_values[tB[0]]
-		
+			pA, pB = tA[0], tB[0]
+
 		else:
 			sys.stderr.write("combination {} {}"
-				" seems to be wrong".format(tA, tB))
+				" seems to be wrong\n".format(tA, tB))
 			exit(1)
 
-		if vA is None or vB is None:
-			continue
+		pairs.append((A, B))
+		idxA.append(pidx[pA])
+		idxB.append(pidx[pB])
+
+	return pairs, np.array(idxA, dtype=int), np.array(idxB, dtype=int)
+
+
+def combine(values, idxA, idxB):
+	""" Distances for all runs and combinations: array[run, pair]. """
+	return np.abs(values[:, idxA] - values[:, idxB])
+
+
+def iter_distances(runs, pairs, distances):
+	""" Generator. Yield (run, A, B, distance), skip missing values. """
+	for r, p in zip(*np.nonzero(~np.isnan(distances))):
+		A, B = pairs[p]
+		yield runs[r], A, B, float(distances[r, p])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__,
+			formatter_class=argparse.RawTextHelpFormatter)
+
+	parser.add_argument('-c', '--combinations',
+			type=argparse.FileType('r'),
+			default='combinations.txt',
+			help="pairs of triggers ('combinations.txt' by default)")
+
+	parser.add_argument('-d', '--distances',
+			type=argparse.FileType('r'),
+			default='distances.txt',
+			help="coordinates of points for each run ('distances.txt' by default)")
+
+	parser.add_argument('-f', '--fitlog',
+			type=argparse.FileType('r'),
+			help="the file with results of fitting, print MPL ratios")
+
+	args = parser.parse_args()
+
+	runs, points, values = load_points(args.distances)
+	pairs, idxA, idxB = load_pairs(args.combinations, points)
+	rows = iter_distances(runs, pairs, combine(values, idxA, idxB))
+
+	if not args.fitlog:
+		for run, A, B, distance in rows:
+			print run, A, B, distance
+		return
+
+	from fit_coeff import read_results, print_combinations
+	index, chans = read_results(args.fitlog)
+	print_combinations(index, chans, rows)
 
-		distance = abs(vA - vB)
 
-		print run, A, B, distance
+if __name__ == "__main__":
+	main()
@@ -1,145 +1,431 @@
 #!/usr/bin/env python
-""" 
-    Calculate typical event rates for channels.
-    Find intervals of time with extraordinary high event rates, 
+"""
+    Find intervals of time with extraordinary high event rates,
     purge them from data flow and print some statistics to stderr.
-    
+
+    Single pass: each interval is compared with a running baseline
+    (median of event counts per channel in the last intervals)
+    and written or dropped as a whole, with one interval of latency.
+    Works in a pipe.
+
+    Counts above the limits are clipped before they enter the baseline,
+    so bursts do not raise it, but after a lasting rise of the rate
+    the baseline follows it (by `factor` each `history` / 2 intervals).
+
+    With --method cusum the rate of each channel is tested in short bins
+    by Poisson CUSUM against the same baseline and only events in bursts
+    are dropped. Burst intervals can be saved (--bursts) and used
+    as a veto mask by coinc.py (--veto). Events are held for --latency
+    intervals: a burst which is detected later than that is dropped
+    only from the held intervals, but the --bursts file has all of it.
+
     input columns: <timestamp> <chan> ...
 """
 
 import sys, os
 import argparse
-from collections import Counter, defaultdict
+from collections import Counter, deque
+from itertools import islice
+from math import log
 
-HZ = 250 * 1000 * 1000 # timestamp = HZ * seconds
+import numpy as np
+
+from rates import HZ, read_records, count_rates, bin_bounds
+
+INTERVAL = 60  # seconds
+FACTOR = 4  # an interval is bad if rate > FACTOR * baseline
+HISTORY = 30  # intervals for the baseline
+WARMUP = 5  # intervals to collect before the first decision
+RESOLUTION = 1  # seconds, bins for cusum
+THRESHOLD = 20  # cusum threshold (log likelihood ratio)
+LATENCY = 2  # intervals to hold for cusum
 
 
 def parse_args():
- 
+
     parser = argparse.ArgumentParser(description=__doc__,
         formatter_class=argparse.RawTextHelpFormatter,
         epilog='(c) Sergey Ryzhikov <sergey.ryzhikov@ihep.ru>, 2016.\nLicense: GPLv2')
-    
+
     parser.add_argument( 'infile',
+            nargs='?',
             type=argparse.FileType('r'),
             default=sys.stdin,
             help='data file (stdin by default)')
 
+    parser.add_argument( '-i', '--interval',
+            type=float,
+            default=INTERVAL,
+            help='interval length in seconds (%d by default)' % INTERVAL)
+
+    parser.add_argument( '-f', '--factor',
+            type=float,
+            default=FACTOR,
+            help='max rate relative to the baseline (%d by default)' % FACTOR)
+
+    parser.add_argument( '--history',
+            type=int,
+            default=HISTORY,
+            help='a number of intervals for the baseline (%d by default)' % HISTORY)
+
+    parser.add_argument( '-m', '--method',
+            choices=('fixed', 'cusum'),
+            default='fixed',
+            help="'fixed' -- drop whole intervals (default),\n"
+                 "'cusum' -- drop bursts found by Poisson CUSUM")
+
+    parser.add_argument( '-r', '--resolution',
+            type=float,
+            default=RESOLUTION,
+            help='bin width in seconds for cusum (%d by default)' % RESOLUTION)
+
+    parser.add_argument( '-t', '--threshold',
+            type=float,
+            default=THRESHOLD,
+            help='cusum threshold (%d by default)' % THRESHOLD)
+
+    parser.add_argument( '-l', '--latency',
+            type=int,
+            default=LATENCY,
+            help='intervals to hold before writing for cusum (%d by default)' % LATENCY)
+
+    parser.add_argument( '-b', '--bursts',
+            metavar='FILE',
+            help='write burst intervals to FILE (a veto for coinc.py)')
+
     parser.add_argument( '--stats',
             #type=bool,
             action='store_true',
             help='print statistics' )
-    
+
     args = parser.parse_args()
     return args
 
 
-def get_chan_rates(infile, interval=60):
-    """ Count event rate statistics per time intervals.
-        Return: channels, [(line_no, Counter),...]
+def read_intervals(infile, interval=INTERVAL):
+    """ Generator. Split records into time intervals.
+        Yield (lines, ts, chans) for each interval.
     """
-    count = Counter()
-    ts_incr = interval * HZ
-    next_ts = None
-    ret = []
-    channels = set()
-    
-    for lineno, line in enumerate(infile):
-        
-        if line[0] == '#':
-            continue  # skip comments
-
-        line = '\t'.join(line.split())  # join spaces
-        ts, chan, rest = line[:-1].split('\t', 2)  #stip '\n' without making a copy of the string
-        ts = float(ts)
-        chan = int(chan)
-        
-        if chan not in channels:
-            channels.add(chan) 
-        count[chan] += 1
-
-        if next_ts is None:
-            next_ts = ts + ts_incr
-
-        if ts > next_ts:
-            next_ts = ts + ts_incr
-            ret.append( (lineno, count) )
-            count = Counter()
-
-    return channels, ret
-
-
-def print_rates(rates):
-    for lineno, counter in rates:
-        print lineno, counter
-
-
-def count_mean_rates(rates):
+    width = interval * HZ
+    t0 = None
+    lines = []  # the last (incomplete) interval
+    parts = []  # (ts, chans) of its blocks
+    last = None
+
+    def flush():
+        ts = np.concatenate([p[0] for p in parts])
+        chans = np.concatenate([p[1] for p in parts])
+        return lines, ts, chans
+
+    for block, ts, chans in read_records(infile):
+
+        if t0 is None:
+            t0 = ts[0]
+
+        idx = ((ts - t0) // width).astype(int)
+        cuts = np.flatnonzero(idx[1:] != idx[:-1]) + 1
+
+        for s, e in zip(np.append(0, cuts), np.append(cuts, len(ts))):
+            if idx[s] != last and lines:
+                yield flush()
+                lines, parts = [], []
+
+            last = idx[s]
+            lines.extend(block[s:e])
+            parts.append((ts[s:e], chans[s:e]))
+
+    if lines:
+        yield flush()
+
+
+class Baseline(object):
+    """ Median event counts per channel in the last intervals,
+        counts are clipped to `factor` * median.
+
+        Counts are vectors with a column for each channel seen so far
+        (NaN if the channel has no events in the interval),
+        the last `history` of them are rows of `counts`.
     """
-    Return mean statistics for each channel.
+    def __init__(self, history=HISTORY, factor=FACTOR):
+        self.history = history
+        self.factor = factor
+        self.chans = {}  # {chan: column}
+        self.counts = np.empty((0, 0))  # [interval, column]
+
+    def count(self, chans):
+        """ Return a vector of event counts for records of `chans`. """
+        uchans, n = np.unique(chans, return_counts=True)
+        for chan in uchans:
+            self.chans.setdefault(chan, len(self.chans))
+
+        ret = np.full(len(self.chans), np.nan)
+        ret[[self.chans[c] for c in uchans]] = n
+        return ret
+
+    def _pad(self, count):
+        """ Add columns of the channels which appeared later. """
+        return np.append(count, np.full(len(self.chans) - len(count), np.nan))
+
+    def clip(self, count, limits):
+        count = self._pad(count)
+        with np.errstate(invalid='ignore'):
+            return np.where(count > limits, limits, count)
+
+    def _append(self, rows):
+        width = len(self.chans)
+        rows = np.vstack([self._pad(r) for r in rows])
+        old = np.hstack((self.counts,
+                np.full((len(self.counts), width - self.counts.shape[1]), np.nan)))
+        self.counts = np.vstack((old, rows))[-self.history:]
+
+    def seed(self, counts):
+        """ Start with the first intervals, clipped to the limits
+            by their own medians.
+        """
+        if not counts:
+            return
+        self._append(counts)
+        limits = self.limits()
+        self.counts = np.empty((0, 0))
+        self._append([self.clip(c, limits) for c in counts])
+
+    def update(self, count):
+        self._append([self.clip(count, self.limits())])
+
+    def medians(self):
+        """ Return medians for each column, NaN for channels
+            without events in the last intervals.
+        """
+        vals = np.sort(self.counts, axis=0)  # NaN are the last
+        n = np.sum(~np.isnan(vals), axis=0)
+        cols = np.arange(vals.shape[1])
+        lo, hi = np.maximum((n - 1) // 2, 0), n // 2
+        ret = np.full(len(self.chans), np.nan)
+        if len(vals):
+            ret[cols] = (vals[lo, cols] + vals[hi, cols]) / 2.0
+        return ret
+
+    def limits(self):
+        return self.factor * self.medians()
+
+    def is_ok(self, count):
+        with np.errstate(invalid='ignore'):
+            return not np.any(self._pad(count) > self.limits())
+
+
+class FixedFilter(object):
+    """ Drop whole intervals where a channel rate exceeds
+        `factor` * baseline.
+    """
+    def __init__(self, baseline):
+        self.baseline = baseline
+        self.bursts = []  # [(start_ts, end_ts), ...]
+        self.stats = Counter()
+
+    def process(self, lines, ts, chans, count):
+        """ Return lines to write. """
+        if self.baseline.is_ok(count):
+            self.stats['good'] += 1
+            return lines
+
+        self.stats['bad'] += 1
+        self.bursts.append((ts[0], ts[-1]))
+        return []
+
+    def flush(self):
+        return []
+
+
+class PoissonCusum(object):
+    """ One-sided Poisson CUSUM for each channel: tests a rise of the
+        rate by `factor` over the baseline rate. An excursion of the
+        statistic above zero which reaches `threshold` is a burst,
+        its bins are bad from the rise to the last elevated bin
+        (where the burst is more likely than the baseline).
+        The statistic is capped at `threshold`.
     """
-    data = defaultdict(list)
+    def __init__(self, factor=FACTOR, threshold=THRESHOLD):
+        self.factor = factor
+        self.lnf = log(factor)
+        self.threshold = threshold
+        self.state = {}  # {chan: (S, peak, start, last elevated) of an open excursion}
+
+    def update(self, chan, counts, rate, times):
+        """ Process `counts` of the channel in consecutive bins starting
+            at `times`, `rate` is the baseline (events per bin).
+            Return (mask of bad bins, time from which the events before
+            these bins are bad or None).
+        """
+        s0, peak0, start0, last0 = self.state.pop(chan, (0., 0., None, None))
+
+        # S[n] = max(0, S[n-1] + llr[n]) for all bins at once
+        llr = counts * self.lnf - (self.factor - 1) * rate
+        c = s0 + np.cumsum(llr)
+        s = c - np.minimum(np.minimum.accumulate(c), 0)
+
+        over = np.flatnonzero(s >= self.threshold)
+        if len(over):
+            # S is capped at the threshold, so it returns to zero soon
+            # after the burst (rare, bin by bin)
+            cur = s[over[0]] = self.threshold
+            for i in range(over[0] + 1, len(s)):
+                cur = min(self.threshold, max(0., cur + llr[i]))
+                s[i] = cur
 
-    for lineno, counter in rates:
-        for chan, val in counter.items():
-            data[chan].append(val)
-    
-    means = {}
-    for chan, vals in data.items():
-        means[chan] = sum(vals)* 1.0/len(vals)
+        pos = s > 0
+        run = np.cumsum(~pos)  # excursion number, 0 -- continued one
+        peak = np.zeros(run[-1] + 1)
+        np.maximum.at(peak, run[pos], s[pos])
+        if s0 > 0:
+            peak[0] = max(peak[0], peak0)
 
-    return means
+        # the last elevated bin of each excursion
+        up = np.flatnonzero(pos & (llr > 0))
+        last = np.full(len(peak), -1, dtype=int)
+        np.maximum.at(last, run[up], up)
+        bad = pos & (peak[run] >= self.threshold) & (np.arange(len(s)) <= last[run])
 
+        retro = None
+        if s0 > 0 and bad[0]:  # the burst goes on from previous bins
+            retro = start0 if peak0 < self.threshold else last0
 
-def check_rates(rates, means):
-    """ Check if rates is good.
-        Return: [(lineno, True|False), ...]
+        if pos[-1]:  # keep an open excursion
+            r = run[-1]
+            if r == 0 and s0 > 0:
+                start = start0
+            else:
+                start = times[np.flatnonzero(~pos)[-1] + 1] if r else times[0]
+            if last[r] >= 0:
+                last0 = times[last[r]]
+            elif r or s0 <= 0:
+                last0 = None
+            self.state[chan] = (s[-1], peak[r], start, last0)
+
+        return bad, retro
+
+
+class CusumFilter(object):
+    """ Drop events in bursts found by Poisson CUSUM in bins
+        of `resolution` seconds. `latency` intervals are held:
+        the beginning of a burst may be in the previous intervals.
     """
-    rate_limits = dict( ((k, v * 4) for k,v in means.items() ))
-    res = []
+    def __init__(self, baseline, interval, resolution, threshold, latency=LATENCY):
+        self.baseline = baseline
+        self.ratio = float(resolution) / interval  # bin / interval
+        self.width = resolution * HZ
+        self.cusum = PoissonCusum(baseline.factor, threshold)
+        self.latency = latency
+        self.t0 = None
+        self.pending = deque()  # [lines, ts, mask] of the held intervals
+        self.bursts = []
+        self.stats = Counter()
+
+    def _bursts(self, bad, times):
+        """ Append contiguous runs of bad bins to self.bursts. """
+        edges = np.diff(np.concatenate(([0], bad.astype(int), [0])))
+        for s, e in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            start, end = times[s], times[e - 1] + self.width
+            if self.bursts and start <= self.bursts[-1][1]:
+                self.bursts[-1] = (self.bursts[-1][0], end)
+            else:
+                self.bursts.append((start, end))
 
-    for lineno, counts in rates:
-        for c, v in counts.items():
-            if v > rate_limits[c]:
-                res.append( (lineno, False))
+    def process(self, lines, ts, chans, count):
+        if self.t0 is None:
+            self.t0 = ts[0]
+
+        bins, uchans, counts = count_rates(ts, chans, self.t0, self.width)
+        times = self.t0 + bins * self.width
+        index = dict((c, j) for j, c in enumerate(uchans))
+
+        bad = np.zeros(len(bins), dtype=bool)
+        retro = None
+        medians = self.baseline.medians()
+        for chan, col in self.baseline.chans.items():
+            med = medians[col]
+            if np.isnan(med):
                 continue
-        res.append( (lineno, True))
+            if chan in index:
+                n = counts[:, index[chan]]
+            else:
+                n = np.zeros(len(bins))
+            b, r = self.cusum.update(chan, n, med * self.ratio, times)
+            bad |= b
+            if r is not None and (retro is None or r < retro):
+                retro = r
+
+        if retro is not None:
+            for held in self.pending:
+                held[2] |= held[1] >= retro
+            if self.bursts and self.bursts[-1][1] >= retro:
+                self.bursts[-1] = (min(self.bursts[-1][0], retro), times[0])
+            else:
+                self.bursts.append((retro, times[0]))
+        self._bursts(bad, times)
+
+        if bad.any():
+            self.stats['burst bins'] += int(bad.sum())
 
-    return res
-    
+        bounds = bin_bounds(ts, self.t0, self.width, bins)
+        mask = np.repeat(bad, np.diff(bounds))
 
-def print_stats(stats):
-    print stats
+        self.pending.append([lines, ts, mask])
+        if len(self.pending) > self.latency:
+            return self._release()
+        return []
 
+    def flush(self):
+        """ Return good lines of all held intervals. """
+        ret = []
+        while self.pending:
+            ret.extend(self._release())
+        return ret
+
+    def _release(self):
+        """ Return good lines of the oldest held interval. """
+        lines, ts, mask = self.pending.popleft()
+        self.stats['intervals'] += 1
+        if not mask.any():
+            return lines
+
+        self.stats['dropped'] += int(mask.sum())
+        return [l for l, bad in zip(lines, mask) if not bad]
 
 
 def main():
     args = parse_args()
-    #print args
 
-    channels, rates = get_chan_rates(args.infile)
-    means = count_mean_rates(rates)
-    checkrates = check_rates(rates, means)
+    baseline = Baseline(args.history, args.factor)
+    if args.method == 'cusum':
+        filt = CusumFilter(baseline, args.interval, args.resolution,
+                args.threshold, args.latency)
+    else:
+        filt = FixedFilter(baseline)
+
+    intervals = read_intervals(args.infile, args.interval)
+
+    # the baseline for the first intervals is their median
+    warmup = list(islice(intervals, WARMUP))
+    counts = [baseline.count(chans) for lines, ts, chans in warmup]
+    baseline.seed(counts)
+    for (lines, ts, chans), count in zip(warmup, counts):
+        sys.stdout.writelines(filt.process(lines, ts, chans, count))
+
+    for lines, ts, chans in intervals:
+        count = baseline.count(chans)
+        sys.stdout.writelines(filt.process(lines, ts, chans, count))
+        baseline.update(count)
+    sys.stdout.writelines(filt.flush())
+
+    if args.bursts:
+        with open(args.bursts, 'w') as f:
+            f.write('#start_ts end_ts\n')
+            for start, end in filt.bursts:
+                f.write('%.0f %.0f\n' % (start, end))
 
     if args.stats:
-        print means
-        pass
-    
-    args.infile.seek(0,0)  # move to beginning of the file
-    lastline, isok = checkrates.pop(0)
-
-    for lineno, line in enumerate(args.infile):
-        
-        while lineno >= lastline:
-            try:
-                lastline, isok = checkrates.pop(0)
-            except IndexError:
-                # end of time interval
-                exit(0)
-        
-        if isok:
-            sys.stdout.write(line)
-
-    
+        sys.stderr.write('{}: {}\n'.format(args.method, dict(filt.stats)))
+
+
 if __name__ == "__main__":
     main()
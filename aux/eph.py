@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 """ Count events per hour for each channel in a sorted list of records.
     input columns: <timestamp> <chan> ...
-    output columns: "<hour> <eph> ... <ephN>"
+    output columns: "<hour> <eph> ... <ephN> <lineno>"
+    Hours are counted from the first timestamp, the header lists all
+    channels, hours without events are printed with zeros and the last
+    incomplete hour is not printed. lineno is a number of records
+    up to the end of the hour (comment lines are not counted).
 """
 
 import sys, os
 import argparse
-from collections import Counter
 
-HZ = 250 * 1000 * 1000 # timestamp = HZ * seconds
+import numpy as np
+
+from rates import HZ, read_records, count_rates
+
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__,
@@ -17,59 +23,47 @@ def main():
     
     
     parser.add_argument( 'infile',
+            nargs='?',
             type=argparse.FileType('r'),
             default=sys.stdin,
             help='data file (stdin by default)')
+
+    parser.add_argument( '-i', '--interval',
+            type=float,
+            default=60 * 60,
+            help='interval in seconds (an hour by default)')
     
     args = parser.parse_args()
     
-    next_ts = None
-    ts_increment = HZ * 60 * 60
-    count = Counter()
-    hr = 0
-    lineno = 0
-    channels = set()
+    width = args.interval * HZ
+    t0 = None
+    blocks = []  # (bins, chans, counts[bin, chan]) for each block of records
     
-    for line in args.infile:
-        
-        lineno +=1
+    for lines, ts, chans in read_records(args.infile):
+
+        if t0 is None:
+            t0 = ts[0]
+
+        blocks.append(count_rates(ts, chans, t0, width))
 
-        if line[0] == '#':
-            continue  # skip comments
+    if not blocks:
+        return
 
-        line = '\t'.join(line.split())
-        ts, chan, rest = line[:-1].split('\t', 2)  #stip '\n' without making a copy of the string
-        ts = float(ts)
-        chan = int(chan)
-        
-        count[chan] += 1
+    channels = np.unique(np.concatenate([b[1] for b in blocks]))
+    nbins = blocks[-1][0][-1] + 1
+    if nbins < 2:
+        return
 
-        if next_ts is None:
-            next_ts = ts + ts_increment
+    count = np.zeros((nbins, len(channels)), dtype=int)  # [bin, chan]
+    for bins, uchans, counts in blocks:
+        count[bins[0]:bins[-1] + 1, np.searchsorted(channels, uchans)] += counts
 
-        elif ts > next_ts:
-            # it's time to print something
-            hr += 1
-            next_ts = ts + ts_increment
-            
-            newchannels = set(count.keys())
-            
-            if newchannels != channels:
-                if newchannels.issubset(channels):
-                    pass
-                
-                else:
-                    #some channels had been added
-                    channels.update(newchannels)
+    strchans = "\t".join(map(str, channels))
+    print( "#hr\ch\t{}\tlineno".format(strchans))
 
-                    strchans = "\t".join(map(str, sorted(channels)))
-                    print( "#hr\ch\t{}\tlineno".format(strchans))
-            
-            #print the data
-            values = [count[c] for c in sorted(channels)]
-            print('%d\t%s\t%d' % (hr, '\t'.join( map(str, values) ), lineno ) ) 
-            
-            count = Counter()
+    lineno = np.cumsum(count.sum(axis=1))
+    for b in range(nbins - 1):  # skip the last hour
+        print('%d\t%s\t%d' % (b + 1, '\t'.join( map(str, count[b]) ), lineno[b] ) ) 
 
     
 if __name__ == "__main__":
@@ -4,6 +4,11 @@
     Read analysis results.
     Calculate coefficients for each channel:
         for each channel and each run divide MPL for trigger A by MPL for trigger B (if any).
+    With --combinations the fit log is read once and ratios are calculated
+    for all lines of the output of distance-combination.py.
+    The run column of the fit log is the common path of the fitted files
+    (like 'data/dec24_0/trig/'), a run from the combinations matches it
+    if it is a component of the path (or a part of it, like `grep`).
 
     Input data fields:
         channel_name run_name trigger_name MPL Chi2 NDF
@@ -25,6 +30,105 @@ ERR_COL = 6
 STD_COL = 14
 CHI2_COL = 8
 
+def read_results(infile):
+    """ Parse the fit log once.
+        Return {(chan, run, trig): (mpl, err)} and a list of channels.
+    """
+    index = {}
+    chans = set()
+    line_count = 0
+
+    for line in infile:
+        line_count += 1
+        
+        if line[0] == "#":
+            #skip comments
+            continue
+        
+        sline = line.split()
+        try:
+            chan = sline[CHAN_COL]
+            run = sline[RUN_COL]
+            trig = sline[TRIG_COL]
+            mpl = sline[MPL_COL]
+            err = sline[ERR_COL]
+            err = err.translate(None,'±')
+
+            std = sline[STD_COL]
+            chi2_ndf = sline[CHI2_COL]
+
+        except IndexError as e:
+            sys.stderr.write("{} \n".format(sline))
+            sys.stderr.write("Wrong line #{}: {}\n".format(line_count, str(e)))
+            exit(1)
+
+        index[(chan, run, trig)] = (mpl, err)
+        chans.add(chan)
+
+    return index, sorted(chans, key=natural_keys)
+
+
+def match_runs(name, runs):
+    """ Return runs of the fit log for a run `name` from distances.txt. """
+    ret = [run for run in runs if name in run.split('/')]
+    return ret or [run for run in runs if name in run]
+
+
+def ratio(a, b):
+    """ MPL ratio and its error for (mpl, err) of triggers A and B. """
+    valA, errA = map(float, a)
+    valB, errB = map(float, b)
+    
+    if valB != 0:
+        val = 1.0 * valA / valB
+        err = val - (valA + errA)/(valB - errB)
+    else:
+        val = None
+        err = None
+    return val, err
+
+
+def read_combinations(infile):
+    """ Generator. Yield (run, trigA, trigB, distance)
+        for lines of the output of distance-combination.py.
+    """
+    for line in infile:
+        if line[0] == "#":
+            continue
+        sline = line.split()
+        if sline:
+            yield sline[:4]
+
+
+def print_ratio(run, chan, trigA, trigB, val, err, distance=None):
+    if distance:
+        print "{} {} {} {} {} {:.4} ±{:.2}".format( run, chan, distance, trigA, trigB, val, abs(err))
+    else:
+        print "{} {} {} {} {:.4} ±{:.2}".format( run, chan, trigA, trigB,  val, abs(err))
+
+
+def print_combinations(index, chans, combinations):
+    """ Print ratios for each (run, trigA, trigB, distance)
+        in `combinations` and each channel.
+    """
+    runs = sorted(set(run for _, run, _ in index), key=natural_keys)
+    matched = {}
+
+    for name, trigA, trigB, distance in combinations:
+        if name not in matched:
+            matched[name] = match_runs(name, runs)
+            if not matched[name]:
+                sys.stderr.write("run {} is not in the fit log\n".format(name))
+
+        for chan in chans:
+            for run in matched[name]:
+                a = index.get((chan, run, trigA))
+                b = index.get((chan, run, trigB))
+                if a and b:
+                    val, err = ratio(a, b)
+                    print_ratio(name, chan, trigA, trigB, val, err, distance)
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__,
             formatter_class=argparse.RawTextHelpFormatter)
@@ -37,11 +141,13 @@ def main():
 
     parser.add_argument('A',
             type=str, 
+            nargs='?',
             help='trigger A'
             )
             
     parser.add_argument('B',
             type=str, 
+            nargs='?',
             help='trigger B'
             )
             
@@ -50,87 +156,35 @@ def main():
             help="print distance"
             )
 
+    parser.add_argument('-c', '--combinations',
+            type=argparse.FileType('r'),
+            metavar='FILE',
+            help="calculate all combinations from a file ('-' for stdin),\n"
+                 "lines: <run> <trigger A> <trigger B> <distance>\n"
+                 "(the output of distance-combination.py)"
+            )
+
     args = parser.parse_args()
-    
+
+    if not args.combinations and not (args.A and args.B):
+        parser.error('triggers A and B or --combinations are required')
     
     ## Readout data
-    data = {}
-    line_count = 0
-    trigs = args.A, args.B
-    allruns = set()
-    
-    for line in args.infile:
-        line_count += 1
-        
-        if line[0] == "#":
-            #skip comments
-            continue
-        
-        line = '\t'.join(line.split())  # replace spaces with tabs
-        try:
-            sline = line.split('\t')
-            chan = sline[CHAN_COL]
-            run = sline[RUN_COL]
-	    
-	    trig = sline[TRIG_COL]
-            mpl = sline[MPL_COL]
-            err = sline[ERR_COL]
-            err = err.translate(None,'±')
+    index, chans = read_results(args.infile)
 
-            std = sline[STD_COL]
-            chi2_ndf = sline[CHI2_COL]
+    if args.combinations:
+        print_combinations(index, chans, read_combinations(args.combinations))
+        return
 
-        except IndexError as e:
-            sys.stderr.write("{} \n".format(sline))
-            sys.stderr.write("Wrong line #{}: {}\n".format(line_count, str(e)))
-            exit(1)
-        
-        allruns.add(run)
-       
-        if trig not in trigs:
-            continue
-            
-        if chan not in data:
-            data[chan] = {}
-        
-        if run not in data[chan]:
-            data[chan][run] = {}
-            
-        data[chan][run][trig] = (mpl,err)
+    runs = sorted(set(run for _, run, _ in index), key=natural_keys)
+    for chan in chans:
+        for run in runs:
+            a = index.get((chan, run, args.A))
+            b = index.get((chan, run, args.B))
+            if a and b:
+                val, err = ratio(a, b)
+                print_ratio(run, chan, args.A, args.B, val, err, args.distance)
 
 
-    def nsort(dic):
-        for key in sorted(dic, key=natural_keys):
-            yield (key, dic[key])
-    
-    
-    ## Calculate values
-    values = {}
-    for chan, cdata in nsort(data):
-        for run, rdata in nsort(cdata):
-            if len(rdata) < 2: 
-                continue
-            valA, errA = map(float, rdata[trigs[0]])
-            valB, errB  = map(float, rdata[trigs[1]])
-            
-            if valB != 0:
-                val = 1.0 * valA / valB
-                err = val - (valA + errA)/(valB - errB)
-            else:
-                val = None
-                err = None
-    
-            if chan not in values:
-                values[chan] = []
-                
-            values[chan].append((run, (val, err) , trigs[0], trigs[1]))
-    
-    for chan, cvals in nsort(values):
-        for run, (val,err), trig0, trig1 in cvals:
-            if args.distance:
-                print "{} {} {} {} {} {:.4} ±{:.2}".format( run, chan, args.distance, trig0, trig1, val, abs(err))
-            else:
-                print "{} {} {} {} {:.4} ±{:.2}".format( run, chan, trig0, trig1,  val, abs(err))
-
 if __name__ == "__main__":
     main()
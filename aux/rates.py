@@ -0,0 +1,56 @@
+"""
+    Event rates of channels in time bins (for eph.py and eph-filter.py).
+    input columns: <timestamp> <chan> ...
+"""
+
+from io import BytesIO
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+HZ = 250 * 1000 * 1000 # timestamp = HZ * seconds
+CHUNK_LINES = 1000 * 1000
+
+
+def read_records(infile, nlines=CHUNK_LINES):
+    """ Generator. Read `infile` by blocks of `nlines`,
+        yield (lines, ts, chans) for each block: data lines
+        (comments are skipped) and arrays of the first two columns.
+    """
+    while True:
+        block = list(islice(infile, nlines))
+        if not block:
+            return
+
+        lines = [l for l in block if l[0] != '#']
+        if not lines:
+            continue
+
+        table = pd.read_csv(BytesIO(''.join(lines)), delim_whitespace=True,
+                header=None, usecols=(0, 1))
+        yield lines, table[0].values.astype(float), table[1].values
+
+
+def count_rates(ts, chans, t0, width):
+    """ Count records in time bins [t0 + i*width, t0 + (i+1)*width)
+        for each channel, `ts` are sorted.
+        Return (bin numbers, channels, counts[bin, chan]).
+    """
+    idx = ((ts - t0) // width).astype(int)
+    first = idx[0]
+    idx -= first
+    nbins = idx[-1] + 1
+
+    uchans, codes = np.unique(chans, return_inverse=True)
+    nchans = len(uchans)
+    counts = np.bincount(idx * nchans + codes, minlength=nbins * nchans)
+    return first + np.arange(nbins), uchans, counts.reshape(nbins, nchans)
+
+
+def bin_bounds(ts, t0, width, bins):
+    """ Return indices of the first record of each bin in `bins`
+        and the end index of the last one.
+    """
+    edges = t0 + np.append(bins, bins[-1] + 1) * width
+    return np.searchsorted(ts, edges)
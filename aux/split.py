@@ -2,68 +2,183 @@
 """
 Split file on timestamp wrap.
 
+The file is memory-mapped and scanned for wrap points in chunks
+by a pool of processes, then fragments are copied with one
+sequential read (os.copy_file_range/os.sendfile if available).
+With --offsets only fragment descriptors are printed:
+	<fragment> <start byte> <length> <filename>
 """
 
 import os
 import sys
-import io
+import mmap
+import argparse
+import multiprocessing
+import numpy as np
 
 BUFSIZE = 1024 * 1024 * 4
+CHUNK = 1024 * 1024 * 16  # bytes per scanning task
+TS_DIGITS = 20  # max digits in a timestamp
 
 
+def parse_ts(buf, starts):
+	""" Parse decimal timestamps at the beginning of lines.
+	Return (ts, ok), `ok` is False for lines without a timestamp.
+	"""
+	last = len(buf) - 1
+	ts = np.zeros(len(starts), dtype=np.int64)
+	alive = np.ones(len(starts), dtype=bool)
+	ndigits = np.zeros(len(starts), dtype=int)
 
-def copypart(fn_from, fn_to, start, sz, bufsize = 1024*1024*4):
+	for k in range(TS_DIGITS):
+		d = buf[np.minimum(starts + k, last)].astype(np.int64) - ord('0')
+		alive &= (d >= 0) & (d <= 9) & (starts + k <= last)
+		if not alive.any():
+			break
+		ts[alive] = ts[alive] * 10 + d[alive]
+		ndigits += alive
+
+	# a timestamp should be followed by whitespace
+	end = buf[np.minimum(starts + ndigits, last)]
+	ok = (ndigits > 0) & ((end == ord(' ')) | (end == ord('\t')) | (end == ord('\n')))
+	return ts, ok
+
+
+def scan_chunk(task):
+	""" Find wrap points in lines which start in [start, stop).
+	Return (first ts, last ts, a number of lines,
+		[(line index, offset), ...] of the first line and of wraps,
+		[line index, ...] of bad lines).
+	"""
+	filename, start, stop = task
+
+	with open(filename, 'rb') as f:
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if start:
+			start = mm.find(b'\n', start - 1) + 1 or len(mm)
+		stop = mm.find(b'\n', stop - 1) + 1 or len(mm)
+		if start >= stop:
+			mm.close()
+			return None, None, 0, [], []
+
+		buf = np.frombuffer(mm, dtype=np.uint8, count=stop - start, offset=start)
+		starts = np.flatnonzero(buf == ord('\n')) + 1
+		starts = np.concatenate(([0], starts[starts < len(buf)]))
+
+		ts, ok = parse_ts(buf, starts)
+		del buf
+		mm.close()
+
+	lines = np.flatnonzero(ok)
+	ts = ts[ok]
+	bad = np.flatnonzero(~ok).tolist()
+	if not len(ts):
+		return None, None, len(starts), [], bad
+
+	wraps = np.append(lines[0], lines[1:][ts[1:] < ts[:-1]])
+	wraps = [(i, start + starts[i]) for i in wraps.tolist()]
+	return ts[0], ts[-1], len(starts), wraps, bad
+
+
+def find_wraps(filename, jobs):
+	""" Return [(line number, offset), ...] of lines with ts wrap. """
+	size = os.path.getsize(filename)
+	tasks = [(filename, a, min(a + CHUNK, size)) for a in range(0, size, CHUNK)]
+
+	pool = multiprocessing.Pool(jobs)
+	wraps = []
+	ts_prev = None
+	lineno = 0
+
+	for first, last, nlines, chunk_wraps, bad in pool.imap(scan_chunk, tasks):
+
+		for i in bad:
+			sys.stderr.write("lineno %d: Wrong ts\n" % (lineno + i + 1))
+
+		if first is not None:
+			if ts_prev is None or first >= ts_prev:
+				chunk_wraps = chunk_wraps[1:]  # no wrap at the first line
+			wraps.extend((lineno + i + 1, off) for i, off in chunk_wraps)
+			ts_prev = last
+
+		lineno += nlines
+
+	pool.close()
+	pool.join()
+	return wraps
+
+
+def copypart(infile, fn_to, start, sz, bufsize=BUFSIZE):
 	""" Copy a part of file to another one """
-	# TODO : use system `dd`
-	length = sz
-	with open(fn_from,'rb') as infile, open(fn_to, 'wb') as outfile:
-		infile.seek(start)
-		while length:
-			chunk = min(bufsize,length)
-			data = infile.read(chunk)
-			outfile.write(data)
-			length -= chunk
-
-	return
+	with open(fn_to, 'wb') as outfile:
+		fd_in, fd_out = infile.fileno(), outfile.fileno()
+		length = sz
+
+		if hasattr(os, 'copy_file_range'):  # in kernel
+			while length:
+				n = os.copy_file_range(fd_in, fd_out, length, start + sz - length)
+				if not n:
+					break
+				length -= n
+
+		elif hasattr(os, 'sendfile'):
+			while length:
+				n = os.sendfile(fd_out, fd_in, start + sz - length, length)
+				if not n:
+					break
+				length -= n
+
+		else:
+			mm = mmap.mmap(fd_in, 0, access=mmap.ACCESS_READ)
+			pos = start
+			while pos < start + sz:
+				chunk = min(bufsize, start + sz - pos)
+				outfile.write(mm[pos:pos + chunk])
+				pos += chunk
+			mm.close()
+
+
+def fragment_name(filename, count):
+	folder, name = os.path.split(filename)
+	return os.path.join(folder, str(count) + "_" + name)
+
 
 def main():
-	filename = sys.argv[1]
-	_file = io.open(filename,'rb', buffering=1024*2024)
-	
-	lineno = 0
-	
-	fragment_start=0 # bytes
-	fragment_end=0  # bytes
-	
-	fragment_count=0 
-	ts_prev=None
-	
-	for line in _file:
-		lineno += 1
-		
-		try:
-			ts = int(line.split()[0])
-		except ValueError:
-			sys.stderr.write("lineno %d: Wrong ts: %s" % (lineno, line))
-		
-		if ts < ts_prev:  # ts wrap
-			
-			sys.stderr.write( "fragment %d, line %d: %s ..." % (fragment_count, lineno, line[:-1]) )
-			
-			# split files
-			fn = str(fragment_count) + "_" + filename
-			copypart(filename, fn, fragment_start, fragment_end-fragment_start)
-			fragment_start = fragment_end
-			sys.stderr.write('ok \n')
-			
-			fragment_count += 1
-		
-		ts_prev = ts
-		fragment_end += len(line)
-	
-	# the last fragment		
-	fn = str(fragment_count) + "_" + filename
-	copypart(filename, fn, fragment_start, fragment_end-fragment_start)
-	
+	parser = argparse.ArgumentParser(description=__doc__,
+			formatter_class=argparse.RawTextHelpFormatter)
+
+	parser.add_argument('infile')
+
+	parser.add_argument('--offsets', action='store_true',
+			help="print fragment offsets, do not copy")
+
+	parser.add_argument('-j', '--jobs', type=int,
+			default=multiprocessing.cpu_count(),
+			help="a number of processes (number of CPUs by default)")
+
+	args = parser.parse_args()
+	filename = args.infile
+
+	wraps = find_wraps(filename, args.jobs)
+	size = os.path.getsize(filename)
+	bounds = [0] + [off for _, off in wraps] + [size]
+
+	with open(filename, 'rb') as infile:
+		for count in range(len(bounds) - 1):
+			start, end = bounds[count], bounds[count + 1]
+			fn = fragment_name(filename, count)
+
+			if args.offsets:
+				print('%d\t%d\t%d\t%s' % (count, start, end - start, filename))
+				continue
+
+			if count:
+				sys.stderr.write("fragment %d, line %d ..." % (count - 1, wraps[count - 1][0]))
+			copypart(infile, fn, start, end - start)
+			if count:
+				sys.stderr.write('ok \n')
+
+
 if __name__ == "__main__":
 	main()
@@ -13,6 +13,17 @@ Triggers:
 
 Output: records with coincidental timestamps (one file per channel). 
 
+Veto (optional):
+	records in time intervals from a file (--veto) are skipped,
+	for example bursts found by `aux/eph-filter.py --method cusum --bursts FILE`.
+
+Monitoring system (optional):
+	clusters which fire the monitoring trigger (--monsys) are written
+	only to its output; running averages of monitoring pulses are used
+	to correct gain of records in other triggers (--adjust), output
+	format is the same as of monsys/monsys_adjust.py:
+	<timestamp> <channel> <adjusted value> <value>
+
 Example:
   `pv -c ../sorted.txt | ./coinc.py -p triggers.txt --jitter=2.0 --stats --progress
 
@@ -34,6 +45,9 @@ TS_COL = 0
 CHAN_COL = 1
 VAL_COL = 2
 
+MON_MIN_PULSES = 50 # minimal number of monitoring pulses for a gain estimate
+MON_TRIM = 10 # percent of the lowest and the highest pulses to skip
+
 Record = namedtuple('Record', 'ts, chan, val, raw')
 
 
@@ -49,10 +63,12 @@ class Coinc(object):
 		self.iostream = iostream
 		self.reader = self._reader(self.iostream, **params)
 		
-	def _reader(self, iostream, threshold = None, jitter=1.0, ts_col=TS_COL, chan_col=CHAN_COL, val_col=VAL_COL ):
+	def _reader(self, iostream, threshold = None, jitter=1.0, veto=None, ts_col=TS_COL, chan_col=CHAN_COL, val_col=VAL_COL ):
 		""" 
 		:threshold: 	- if set, records with values less
 				than `threshold` are ignored;
+		:veto:		- if set, records in vetoed time intervals
+				are ignored (see Veto);
 		:jitter: 	- maximum diff of timestamps;
 		:ts_col:	- an index of column with a timestamp;
 		:chan_col:	- 
@@ -98,6 +114,10 @@ class Coinc(object):
 			if val < threshold:	# always false if threshold is None
 				self.counts['nthreshold'] += 1
 				continue # just ignore current line
+			
+			if veto and veto.check(ts):
+				self.counts['nveto'] += 1
+				continue
 
 			if ts - jitter > prev_ts:  # true if prev_ts is None, since None is < than any value
 			 	# not in the same cluster
@@ -129,6 +149,29 @@ class Coinc(object):
 	__next__ = next 	# reqiured for Python 3
 
 
+class Veto(object):
+	""" Time intervals to skip (bursts found by aux/eph-filter.py --bursts).
+	File format: <start_ts> <end_ts> per line, sorted by start_ts.
+	"""
+	def __init__(self, iostream):
+		self.intervals = []
+		for line in iostream:
+			if line[0] == '#':
+				continue
+			fields = line.split()
+			if fields:
+				self.intervals.append( (float(fields[0]), float(fields[1])) )
+		self.intervals.sort()
+		self.idx = 0
+	
+	def check(self, ts):
+		""" True if `ts` is in a vetoed interval, `ts` should not decrease. """
+		intervals = self.intervals
+		while self.idx < len(intervals) and intervals[self.idx][1] < ts:
+			self.idx += 1
+		return self.idx < len(intervals) and intervals[self.idx][0] <= ts
+
+
 class CombinationsTrigger(object):
 	""" Channels are match specified pattern.
 	"""
@@ -160,6 +203,52 @@ class CombinationsTrigger(object):
 		return ret
 		
 
+class MonGain(object):
+	""" Running averages of monitoring system pulses for each channel:
+	the mean of the last `window` pulses without MON_TRIM percent
+	of the lowest and the highest ones (like monsys_avg.py does),
+	so lost or piled-up pulses do not shift the gain.
+	The gain factor is the current average divided by the first full
+	average (like in monsys/monsys_adjust.py).
+	The average is monsys/smoothing.py RollingTrimmedMean, imported here
+	so that numpy is needed only with --adjust.
+	"""
+	def __init__(self, window=100, trim=MON_TRIM):
+		if window < MON_MIN_PULSES:
+			raise ValueError('window should be at least %d pulses' % MON_MIN_PULSES)
+		sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monsys'))
+		from smoothing import RollingTrimmedMean
+		self.window = window
+		self.mean = RollingTrimmedMean(window, trim)
+		self.count = {}  # pulses so far
+		self.avg = {}  # the current average
+		self.ref = {}  # the first full average
+	
+	def update(self, chan, val):
+		avg = self.mean.update(chan, val)
+		self.count[chan] = self.count.get(chan, 0) + 1
+		if self.count[chan] < self.window:
+			return
+		
+		if avg <= 0:
+			return  # no signal, keep the last average
+		
+		self.avg[chan] = avg
+		if chan not in self.ref:
+			self.ref[chan] = avg
+	
+	def factor(self, chan):
+		""" 1.0 until the first full average for the channel. """
+		if chan not in self.ref:
+			return 1.0
+		return self.avg[chan] / self.ref[chan]
+	
+	def adjust(self, record):
+		""" Return an output line for the record. """
+		adjval = record.val * self.factor(record.chan)
+		return '{:.0f} {} {:.2f} {:.2f}\n'.format(record.ts, record.chan, adjval, record.val)
+
+
 #///////////////////////////////////////////////////////////////////////
 
 def print_err(format_str, *args, **kvargs):
@@ -226,6 +315,21 @@ def main():
 			metavar='VALUE',
 			help="skip line when value is less then threshold")
 		
+	parser.add_argument('--veto', type=argparse.FileType('r'),
+			metavar='FILE',
+			help="skip records in time intervals from a file (aux/eph-filter.py --bursts)")
+	
+	parser.add_argument('--monsys', type=str, default=None,
+			metavar='TRIG',
+			help="the name of monitoring system trigger, its clusters are not written to other triggers")
+	
+	parser.add_argument('--mon-window', type=int, default = 100,
+			metavar='N',
+			help="average last N monitoring pulses for each channel, at least %d (default: 100)" % MON_MIN_PULSES)
+	
+	parser.add_argument('--adjust', action='store_true',
+			help="correct gain of records in other triggers by monitoring system data, --monsys required")
+	
 	parser.add_argument('--stats', action='store_true',
 			help="print some counters afterwards")
 			
@@ -242,6 +346,12 @@ def main():
 	args = parser.parse_args()
 	#~ print_err(args)
 	
+	if args.adjust and not args.monsys:
+		parser.error('--adjust requires --monsys')
+	
+	if args.adjust and args.mon_window < MON_MIN_PULSES:
+		parser.error('--mon-window should be at least %d' % MON_MIN_PULSES)
+	
 	debug = args.debug
 	
 	iostream = io.open(args.file, 'rb', buffering=1024*1024)
@@ -254,6 +364,10 @@ def main():
 		trigrules.extend(args.chan_pattern)
 
 	trigger_conf = parse_chan_patterns(trigrules)
+	
+	if args.monsys and args.monsys not in trigger_conf:
+		print_err('No pattern for monitoring trigger "%s"' % args.monsys)
+		exit(1)
 	#~ trigger_conf = dict(
 			#~ A = ('0','1'),
 			#~ B1 = ('0','8'),
@@ -292,8 +406,11 @@ def main():
 	
 
 	# Finally do the Job:
-	coinc = Coinc(iostream, threshold = args.threshold, jitter=args.jitter)
+	veto = Veto(args.veto) if args.veto else None
+	coinc = Coinc(iostream, threshold = args.threshold, jitter=args.jitter, veto=veto)
 	trig = CombinationsTrigger(trigger_conf)
+	monsys = args.monsys
+	gain = MonGain(args.mon_window) if args.adjust else None
 	
 	count = 0
 	for cluster in coinc:
@@ -305,10 +422,24 @@ def main():
 			continue
 		
 		triggers = trig.check(cluster, jitter = args.jitter)
+		
+		if monsys and any(monsys in trigs for trigs in triggers):
+			# monitoring system cluster
+			for idx, trigs in enumerate(triggers):
+				if monsys in trigs:
+					record = cluster[idx]
+					outstreams[monsys].write(record.raw)
+					if gain:
+						gain.update(record.chan, record.val)
+			coinc.counts['monsys'] += 1
+			continue
 
 		for idx, trigs in enumerate(triggers):
 			for tr in trigs:
-				outstreams[tr].write(cluster[idx].raw)
+				if gain:
+					outstreams[tr].write(gain.adjust(cluster[idx]))
+				else:
+					outstreams[tr].write(cluster[idx].raw)
 				count +=1
 				if args.progress and count % 2000 == 0:
 					sys.stderr.write(str(coinc.stats) + '\r')
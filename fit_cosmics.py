@@ -10,8 +10,12 @@ If several maximums found, print them all.
 
 import sys
 import os
+import argparse
+import multiprocessing
+import json
+from array import array
 import numpy as np
-from matplotlib import pyplot as plt
+import matplotlib
 from scipy.stats import gaussian_kde
 from scipy.signal import argrelmax
 from scipy.optimize import fmin
@@ -20,11 +24,11 @@ from util import natural_keys
 VALUE_COLUMN = 2  # a column number with the value 
 CHANNEL_COLUMN = 1  # a column number for channel, None if not the case
 
-gui = False
-gui = True
-
 threshold = 200
 
+KDE_GRID = 2 ** 12  # minimal number of grid points for binned KDE
+KDE_GRID_STEP = 0.05  # maximal grid step for binned KDE, in bandwidths
+
 def common_start(*strings):
     """ Returns the longest common substring
         from the beginning of the `strings`
@@ -39,55 +43,139 @@ def common_start(*strings):
     return ''.join(_iter())
 
 
-def parse_values(fileobjects, channels=set()):
-    """ Parse datafile.
-    Return a dict of ditcts of lists: {chanel: { filename : [values]} }.
+def parse_file(filename, channels=None):
+    """ Parse datafile, skip channels which are not in `channels` (if any).
+    Return a dict of arrays: {chanel: values}.
     """
-    data = {}
+    filedata = {}
 
-    for fileobj in fileobjects:
-        filename = fileobj.name
-
-        filedata = {}
-        for line in fileobj: 
-            line = '\t'.join(line.split())  # join consecutive spaces
-            sline = line.split('\t')
-            value = float(sline[VALUE_COLUMN])
+    with open(filename, 'r') as fileobj:
+        for line in fileobj:
+            sline = line.split()
             chan = sline[CHANNEL_COLUMN] if CHANNEL_COLUMN is not None else None
-            
+
+            if channels and chan not in channels:
+                continue
+
             try:
-                filedata[chan].append(value)
+                filedata[chan].append(float(sline[VALUE_COLUMN]))
             except KeyError:
-                filedata[chan] = []
-                filedata[chan].append(value)
-            
-        for chan, values in filedata.items():
-            if channels and chan not in channels:
-                pass
+                filedata[chan] = array('d', [float(sline[VALUE_COLUMN])])
+
+    return dict((chan, np.frombuffer(vals)) for chan, vals in filedata.items())
+
+
+def _parse_file_task(task):
+    filename, channels = task
+    return filename, parse_file(filename, channels)
+
+
+def _scan_channels_task(filename):
+    """ Return a set of channel names in the file. """
+    with open(filename, 'r') as fileobj:
+        return set(line.split()[CHANNEL_COLUMN] for line in fileobj)
+
+
+def list_channels(filenames, pool=None):
+    """ Return channel names from all files in natural order. """
+    if CHANNEL_COLUMN is None:
+        return [None]
+    _map = pool.imap_unordered if pool else map
+    chans = set()
+    for file_chans in _map(_scan_channels_task, filenames):
+        chans.update(file_chans)
+    return sorted(chans, key=natural_keys)
+
 
+def parse_values(filenames, channels=None, pool=None):
+    """ Parse datafiles (in parallel if `pool` is given).
+    Return a dict of ditcts of arrays: {chanel: { filename : values} }.
+    """
+    data = {}
+    tasks = [(fn, channels) for fn in filenames]
+    _map = pool.imap_unordered if pool else map
+
+    for filename, filedata in _map(_parse_file_task, tasks):
+        for chan, values in filedata.items():
             if chan not in data:
                 data[chan] = {}
-            data[chan][filename] = np.array(values)
+            data[chan][filename] = values
     
     return data
 
-def fit_cosmics(title, cdata):
-    """
+class BinnedKDE(object):
+    """ Gaussian KDE on a regular grid: the data are linearly binned
+    to the grid and convolved with the kernel via FFT.
+    The bandwidth is the same as in gaussian_kde (Scott's rule).
 
+    With the grid step of KDE_GRID_STEP bandwidths, the peak positions
+    agree with gaussian_kde within 2e-4 of the bandwidth
+    (1.2e-4 at most on test samples).
     """
-    
-    if gui:
-        fig, ax = plt.subplots()
+    def __init__(self, dataset):
+        dataset = np.asarray(dataset, dtype=float)
+        n = len(dataset)
+        bw = np.std(dataset, ddof=1) * n ** (-1. / 5)
+        lo = dataset.min() - 5 * bw
+        hi = dataset.max() + 5 * bw
+
+        npoints = max(KDE_GRID, int((hi - lo) / (bw * KDE_GRID_STEP)) + 1)
+        grid, step = np.linspace(lo, hi, npoints, retstep=True)
+
+        # linear binning
+        pos = (dataset - lo) / step
+        idx = np.minimum(pos.astype(int), npoints - 2)
+        frac = pos - idx
+        counts = np.bincount(idx, 1 - frac, npoints) \
+                + np.bincount(idx + 1, frac, npoints)
+
+        # circular convolution, zero padding prevents the wrap-around
+        size = 2 * npoints
+        dist = np.minimum(np.arange(size), size - np.arange(size)) * step
+        kernel = np.exp(-0.5 * (dist / bw) ** 2)
+        conv = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel), size)
+
+        self.bandwidth = bw
+        self.grid = grid
+        self.step = step
+        self.density = conv[:npoints] / (n * bw * np.sqrt(2 * np.pi))
+
+    def __call__(self, points):
+        return np.interp(np.atleast_1d(points), self.grid, self.density)
+
+    def maxima(self, xmin=-np.inf, xmax=np.inf):
+        """ Return positions of local maxima in [xmin, xmax],
+            refined by parabolic interpolation on the grid.
+        """
+        y = self.density
+        idx = argrelmax(y)[0]
+        y0, y1, y2 = y[idx - 1], y[idx], y[idx + 1]
+        offset = 0.5 * (y0 - y2) / (y0 - 2 * y1 + y2)  # strict maxima: < 0
+        x = self.grid[idx] + offset * self.step
+        return list(x[(x >= xmin) & (x <= xmax)])
+
+
+def common_name(names):
+    """ A common prefix of file names (up to the first '_' in the basename).
+    """
+    common = os.path.commonprefix(names)
+    dir_len  = len(os.path.dirname(common))
+    common_len = max(dir_len, common.find('_',dir_len))
+    return common[:common_len+1]
 
-    common_name = os.path.commonprefix(cdata.keys())
-    dir_len  = len(os.path.dirname(common_name))
-    common_len = max(dir_len, common_name.find('_',dir_len))
-    common_name = common_name[:common_len+1]
 
-    hist_maxscale = 0
+def find_peaks(cdata, kde_method='binned'):
+    """ Find the most probable value for each dataset in `cdata`
+        with KDE (`kde_method` is 'exact' or 'binned').
+
+        Return a list of dicts (one per dataset) with the result
+        and the data to plot.
+    """
+    prefix = common_name(cdata.keys())
+    ret = []
 
     for name, data in sorted(cdata.items()):
-        label = name[len(common_name):]
+        label = name[len(prefix):]
         label = os.path.splitext(label)[0]
         
         data = data[data > threshold]
@@ -103,34 +191,34 @@ def fit_cosmics(title, cdata):
         
         data_hist = data[(data> hist_range[0]) &(data < hist_range[1])]
 
-        vals, bins, patches = plt.hist(
+        vals, bins = np.histogram(
             data_hist,
             bins = hist_bins,
             range = hist_range,
-            histtype = 'step',
-            normed = True,
-            label = label,  # strip common part
+            density = True,
         )
 
-        hist_maxscale = max( hist_maxscale, max(vals))
-            
-        color = patches[0].get_edgecolor()
-
         #get kde parameter  
         
-        kde = gaussian_kde(data_hist)
-        kde_vals = kde(bins)
-        maxima_idx = argrelmax(kde_vals)[0]
-        maxima_x = [bins[i] for i in maxima_idx]
-        
-        def minfunc(x, *args):
-            return -kde(x)[0]
+        if kde_method == 'binned':
+            kde = BinnedKDE(data_hist)
+            kde_vals = kde(bins)
+            maxima_x_optim = kde.maxima(*hist_range)
 
-        # impove_results
-        maxima_x_optim = []
-        
-        for x0 in maxima_x:
-            maxima_x_optim.extend(fmin(minfunc,x0,disp=False))
+        else:
+            kde = gaussian_kde(data_hist)
+            kde_vals = kde(bins)
+            maxima_idx = argrelmax(kde_vals)[0]
+            maxima_x = [bins[i] for i in maxima_idx]
+            
+            def minfunc(x, *args):
+                return -kde(x)[0]
+
+            # impove_results
+            maxima_x_optim = []
+            
+            for x0 in maxima_x:
+                maxima_x_optim.extend(fmin(minfunc,x0,disp=False))
 
         if len(maxima_x_optim) == 1:
             result =  maxima_x_optim[0]
@@ -149,32 +237,203 @@ def fit_cosmics(title, cdata):
         else:
             result = None
 
+        ret.append(dict(
+            name = name,
+            label = label,  # strip common part
+            result = result,
+            hist = vals,
+            bins = bins,
+            kde = kde_vals,
+            ))
+
+    return ret
+
+
+def _find_peaks_task(task):
+    chan, cdata, kde_method = task
+    return chan, find_peaks(cdata, kde_method)
+
+
+def print_results(title, results, fmt='text'):
+    """ Print results for channel `title`
+        in `fmt`: 'text' (space separated) or 'tsv'.
+    """
+    for res in results:
+        result = res['result']
         if result:
             result = "{:.2f}".format(result)
 
-        print '{} {} {} {}'.format(title, name, label, result)
+        if fmt == 'tsv':
+            print '\t'.join(map(str, (title, res['name'], res['label'], result)))
+        else:
+            print '{} {} {} {}'.format(title, res['name'], res['label'], result)
+
 
-        plt.plot(bins, kde_vals, '-', color= color)
+def json_results(title, results):
+    """ Return results for channel `title` as a list of dicts. """
+    return [dict(chan=title, file=res['name'], label=res['label'],
+            result=res['result']) for res in results]
 
-    if gui:
-        fig.canvas.set_window_title(common_name)
-        plt.title(title)
-        plt.legend()
-        plt.grid()
-        ax.set_ylim(0,hist_maxscale)
+
+def plot_results(title, window_title, results, outfile=None, show=True):
+    """ Plot histograms and KDE, save the figure to `outfile` (if any),
+        show it (if `show`).
+    """
+    from matplotlib import pyplot as plt
+
+    fig, ax = plt.subplots()
+    hist_maxscale = 0
+
+    for res in results:
+        bins = res['bins']
+        vals, _, patches = plt.hist(
+            bins[:-1],
+            bins = bins,
+            weights = res['hist'],
+            histtype = 'step',
+            label = res['label'],
+        )
+
+        hist_maxscale = max( hist_maxscale, max(vals))
+        color = patches[0].get_edgecolor()
+        plt.plot(bins, res['kde'], '-', color= color)
+
+    fig.canvas.set_window_title(window_title)
+    plt.title(title)
+    plt.legend()
+    plt.grid()
+    ax.set_ylim(0,hist_maxscale)
+
+    if outfile:
+        fig.savefig(outfile)
+
+    if show:
         plt.show()
 
+    plt.close(fig)
+
+
 def nsort(dic):
     for key in sorted(dic, key=natural_keys):
         yield (key, dic[key])
 
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('infiles',
+            nargs='+',
+            help='the files with data records'
+            )
+
+    parser.add_argument('-c','--chan',
+            type = lambda v: set(v.split(',')),
+            metavar = 'LIST',
+            help='get data only for specified channel names'
+                ' (separated by commas)'
+            )
+
+    parser.add_argument('-o','--output',
+            type=str,
+            metavar='PATH',
+            help="save plots to PATH, one file per channel"
+            )
+
+    parser.add_argument('-f','--format',
+            choices=('text', 'tsv', 'json'),
+            default='text',
+            help="results format ('text' by default)"
+            )
+
+    parser.add_argument('--batch',
+            action='store_true',
+            help="do not show plots (only save them if --output is given)"
+            )
+
+    parser.add_argument('--plot-format',
+            default='png',
+            help="a format of plots in --output ('png' by default)"
+            )
+
+    parser.add_argument('-j', '--jobs',
+            type = int,
+            default = multiprocessing.cpu_count(),
+            help = 'a number of processes (number of CPUs by default)'
+            )
+
+    parser.add_argument('-n', '--nchan',
+            type = int,
+            default = None,
+            help = 'keep values of at most NCHAN channels in memory,\n'
+                'the files are read once for each group of channels\n'
+                '(and once more to list them if --chan is not given)'
+            )
+
+    parser.add_argument('--kde',
+            choices=('binned', 'exact'),
+            default='binned',
+            help="'binned' -- FFT on a fine grid (fast, default),\n"
+                "'exact' -- scipy.stats.gaussian_kde (slow for big datasets)"
+            )
+
+    return parser.parse_args()
+
+
 def main():
-    filenames = sys.argv[1:]
-    infiles = [open(fn, 'ro') for fn in filenames]
-    data = parse_values(infiles)
+    args = parse_args()
+
+    if args.batch:
+        matplotlib.use('Agg')
+
+    plot = args.output or not args.batch
+
+    if args.output and not os.path.exists(args.output):
+        os.makedirs(args.output)
 
-    for chan, cdata in nsort(data):
-        fit_cosmics(chan, cdata)
+    if args.format == 'tsv':
+        print '\t'.join(('chan', 'file', 'label', 'result'))
+
+    json_data = []
+    pool = multiprocessing.Pool(args.jobs)
+
+    if args.nchan:
+        # only values of `nchan` channels are in memory at a time,
+        # the files are read once for each group of channels
+        if args.chan:
+            channels = sorted(args.chan, key=natural_keys)
+        else:
+            channels = list_channels(args.infiles, pool)
+        groups = [set(channels[i:i + args.nchan])
+                for i in range(0, len(channels), args.nchan)]
+    else:
+        groups = [args.chan]  # one pass over the files
+
+    for group in groups:
+        data = parse_values(args.infiles, channels=group, pool=pool)
+        tasks = [(chan, data.pop(chan), args.kde)
+                for chan in sorted(data.keys(), key=natural_keys)]
+        del data
+
+        for chan, results in pool.imap(_find_peaks_task, tasks):
+            if args.format == 'json':
+                json_data.extend(json_results(chan, results))
+            else:
+                print_results(chan, results, args.format)
+                sys.stdout.flush()
+
+            if plot:
+                outfile = os.path.join(args.output,
+                        '{}.{}'.format(chan, args.plot_format)) \
+                        if args.output else None
+                plot_results(chan, common_name([r['name'] for r in results]),
+                        results, outfile=outfile, show=not args.batch)
+
+    if args.format == 'json':
+        json.dump(json_data, sys.stdout, indent=1)
+        print
+
+    pool.close()
+    pool.join()
 
 if __name__ == "__main__":
     main()
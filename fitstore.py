@@ -0,0 +1,98 @@
+"""
+    A file-based store for fit results (SQLite).
+
+    One row per fit, keyed by (run, chan, trig).
+    Parameters, errors and covariance are stored as JSON lists.
+"""
+
+import json
+import sqlite3
+import time
+
+from util import natural_keys
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fits (
+    run TEXT NOT NULL,
+    chan TEXT NOT NULL,
+    trig TEXT NOT NULL,
+    mpl REAL,
+    mpl_err REAL,
+    chi2 REAL,
+    ndf REAL,
+    status INTEGER,
+    ncalls INTEGER,
+    params TEXT,
+    errors TEXT,
+    cov TEXT,
+    created REAL,
+    PRIMARY KEY (run, chan, trig)
+)
+"""
+
+MPL_IDX = 1  # MPL parameter index (see LANGAUS_NAMES)
+
+
+class FitStore(object):
+    """ Save and load fit results.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(SCHEMA)
+
+    def save(self, run, chan, trig, fitres):
+        """ Save a fit result (TFitResult or alike), replace the previous one.
+        """
+        npar = len(fitres.Parameters())
+        params = [float(fitres.Parameter(i)) for i in range(npar)]
+        errors = [float(fitres.ParError(i)) for i in range(npar)]
+        cov = [[float(fitres.CovMatrix(i, j)) for j in range(npar)]
+                for i in range(npar)]
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO fits VALUES"
+            " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run, chan, trig,
+                params[MPL_IDX], errors[MPL_IDX],
+                float(fitres.Chi2()), float(fitres.Ndf()),
+                int(fitres.Status()), int(fitres.NCalls()),
+                json.dumps(params), json.dumps(errors), json.dumps(cov),
+                time.time())
+            )
+        self.conn.commit()
+
+    def load(self, run, chan, trig):
+        """ Return a dict with the stored fit result or None.
+        """
+        cur = self.conn.execute(
+            "SELECT * FROM fits WHERE run=? AND chan=? AND trig=?",
+            (run, chan, trig))
+        row = cur.fetchone()
+        if row is None:
+            return None
+
+        ret = dict(zip([d[0] for d in cur.description], row))
+        for k in ('params', 'errors', 'cov'):
+            ret[k] = json.loads(ret[k])
+        return ret
+
+    def previous(self, run, chan, trig):
+        """ Return parameters of the nearest previous run (in natural order)
+            with a successful fit (status 0) for the same channel and trigger
+            or None.
+        """
+        runs = [r for (r,) in self.conn.execute(
+            "SELECT run FROM fits WHERE chan=? AND trig=? AND status=0",
+            (chan, trig))]
+
+        key = natural_keys(run)
+        prev = [r for r in runs if natural_keys(r) < key]
+        if not prev:
+            return None
+
+        nearest = max(prev, key=natural_keys)
+        return self.load(nearest, chan, trig)['params']
+
+    def close(self):
+        self.conn.close()
@@ -4,13 +4,23 @@
 Get data to find optimal HV settings for each channel cosmics setup.
   
 Measure event rates in SIS3316 ADC while changing HV value and ADC threshold in specified range.
+
+By default HV of each channel is changed by coarse steps until the rate
+stops growing and then by fine steps near the knee of the plateau
+(--scan plateau), or all points of the range are measured (--scan grid).
+The HV unit and the ADC of a crate are commanded at the same time
+(HV values are set and settle while ADC thresholds are written), several
+crates (--crate) are tuned in parallel, output lines are prefixed with
+the crate number. Commands to one device go one by one: each device is
+one connection, and a retry delays only the commands to its device.
 """
 
 import sys
 import os
 import argparse
 import time
-
+import threading
+from math import sqrt
 
 from time import sleep
 from collections import Counter
@@ -20,12 +30,18 @@ from operator import div
 from util import makedirs
 from util import setlog#, log_errors
 from util import retry
+from util import parallel
 
-# https://github.com/sergey-inform/SIS3316
-import sis3316
+# Not required to run with hv/mock_devices.py
+try:
+    # https://github.com/sergey-inform/SIS3316
+    import sis3316
 
-# https://github.com/sergey-inform/panda-fsc-hvctl
-from hvctl import HVUnit
+    # https://github.com/sergey-inform/panda-fsc-hvctl
+    from hvctl import HVUnit
+except ImportError as e:
+    sis3316 = HVUnit = None
+    import_error = e
 
 OUTDIR = "./hvtune_out/"
 hv_range = range(2000, 2601, 25)
@@ -58,9 +74,14 @@ HV_CHANS = { # channel to HV channel
     
 MINIMAL_RATE = 1.0 # eps. no reason to set threshold higher if this rate on all channels.
 
+COARSE_STEP = 100  # V, plateau search
+FINE_STEP = 25  # V, near the knee
+PLATEAU_GROWTH = 0.05  # the rate grows less than by 5% per coarse step on the plateau
+
 # /////////////////////////////////////////////
 
-get_mtime = lambda: int(round(time.time() * 1000))
+now = time.time  # replaced by hv/mock_devices.py
+get_mtime = lambda: int(round(now() * 1000))
 logger=None  # will be instantiated by setlog() 
 
 
@@ -109,7 +130,10 @@ class HV(object):
         self.dev = HVUnit(*params)
         self.logger = logger
         self.memory = dict()
+        self.ready = 0  # time when HV is settled after on/off
+        self.name = "HV Unit {}.".format(params)
 
+    @myretry(10)
     def connect(self):
         """ Check the unit is responding. """
         hv_responce = self.dev.cmd('v')[:-1]  # trim \n
@@ -129,14 +153,18 @@ class HV(object):
         if self.is_on():
             self.logger.debug("turn HV off.")
             hv.off()
+            self.ready = now() + self.HV_DELAY
             self.wait()
 
     @myretry(10)
-    def on(self):
+    def on(self, wait=True):
+        """ With wait=False return at once, call wait() before measurements. """
         hv = self.dev
         if not self.is_on():
             self.logger.debug("turn HV on.")
             hv.on()
+            self.ready = now() + self.HV_DELAY
+        if wait:
             self.wait()
 
     @myretry(10)
@@ -152,18 +180,26 @@ class HV(object):
         self.memory[chan] = value
 
     def wait(self):
-        delay = self.HV_DELAY
-        self.logger.debug("wait {} seconds...".format(delay))
-        sleep(delay)
+        """ Wait until HV is settled after the last on/off. """
+        delay = self.ready - now()
+        if delay > 0:
+            self.logger.debug("wait {:.0f} seconds...".format(delay))
+            sleep(delay)
 
     # Procedures
     def set_all(self, value, channels=ALL_CHANNELS):
-        """ Set HV values in a smart way: without turning HV off 
-        if value changes not too harsh.
+        """ Set the same HV value for `channels`. """
+        self.set_values(dict.fromkeys(channels, value))
+    
+    def set_values(self, values, wait=True):
+        """ Set HV values {chan: value} in a smart way: without turning HV off 
+        if values change not too harsh.
         """
         memo = self.memory
-        if value > 4000 or value < 1:
-            raise ValueError("Wrong value %d." % value)
+        channels = values.keys()
+        for value in values.values():
+            if value > 4000 or value < 1:
+                raise ValueError("Wrong value %d." % value)
         
         # If at least one channel was not set previously (not in memory)
         # then turn HV off before seting the values.
@@ -177,7 +213,7 @@ class HV(object):
         # (to not to change HV value harshly).
 
         for chan in channels:
-            if chan in memo and abs(memo[chan] - value) > self.MAX_STEP:
+            if chan in memo and abs(memo[chan] - values[chan]) > self.MAX_STEP:
                 self.off()
                 self.reset()
                 break
@@ -189,17 +225,19 @@ class HV(object):
         
         # Set the new values
         for chan in channels:
-            self.set(chan, value)
+            self.set(chan, values[chan])
         
-        self.on()
+        self.on(wait)
         
 
-
 class ADC(object):
     """A wrapper object for ADC readout.
     """
     name = "ADC Unit"
     ALL_CHANNELS = range(0,16)
+    POLL = 2  # seconds between polls of event counters
+    PRECISION = 0.02  # target relative error of rates
+    MAX_TIME = 120  # seconds, a measurement of all channels ends after it
     
     def __init__(self, addr, *params):
         self.dev = sis3316.Sis3316_udp(addr, *params)
@@ -232,50 +270,179 @@ class ADC(object):
         return [(self.dev.chan[ch].trig.threshold - 0x8000000) for ch in channels]
     
     @myretry(10)
-    def measure_rates(self, channels=ALL_CHANNELS):
+    def poll_counts(self, channels):
+        """ Bytes in ADC memory for `channels` (counters are not reset). """
+        return self.dev.poll_act(channels)
+    
+    @myretry(10)
+    def measure_rates(self, channels=ALL_CHANNELS, precision=None, max_time=None):
+        """ Measure event rates until the relative Poisson error 1/sqrt(N)
+        is less than `precision` for each channel. A channel with a rate
+        certainly below MINIMAL_RATE is done as well.
+        The limit `max_time` (s) is common for all channels: after it the
+        measurement ends and slow channels keep the precision they reached.
+        """
         adc = self.dev
-        ts_summ = 0
+        precision = precision or self.PRECISION
+        max_time = 1000 * (max_time or self.MAX_TIME)
+        min_counts = 1.0 / precision ** 2
         
-        ts_prev = get_mtime()
+        ts_start = get_mtime()
         adc.mem_toggle()  # flush ADC memory
         
-        total_mtime = 0
-        total_bytes = [0] * 16
-        prev_rates = None
-        
         while True:
-            sleep(10)
-            ts = get_mtime()
-            ts_diff = ts - ts_prev
-            ts_prev = ts
+            sleep(self.POLL)
+            total_mtime = get_mtime() - ts_start
             
-            byte_counts = adc.poll_act(channels)
+            byte_counts = self.poll_counts(channels)
+            counts = [1.0 * bc / EVENT_SZ for bc in byte_counts]
+            rates = [round(1000.0 * n / total_mtime, 3) for n in counts]
             
-            total_mtime += ts_diff
+            pending = []
+            for chan, n in zip(channels, counts):
+                if n >= min_counts:
+                    continue
+                upper = 1000.0 * (n + 3 * sqrt(n) + 3) / total_mtime  # ~3 sigma
+                if upper < MINIMAL_RATE:
+                    continue
+                pending.append(chan)
             
-            for idx, bc in enumerate(byte_counts):
-                total_bytes[idx] = bc
-            
-            rates = []
-            for bc in total_bytes:
-                rate = 1000.0 * bc / EVENT_SZ / total_mtime
-                rates.append(round(rate,3))
+            sys.stderr.write("{:.0f} s, waiting for {}  \r".format(total_mtime / 1000.0, pending))
+            if not pending or total_mtime >= max_time:
+                break
+
+        return dict(zip(channels,rates))
+        
+
+class PlateauPlanner(object):
+    """ Plan HV set-points for each channel to find the rate plateau.
+    
+    Coarse steps up from `hv_min` until the rate grows by less than
+    `growth` per step: the last but one point is on the plateau and
+    the knee is below it, so fine steps are made between the two coarse
+    points before it. After that the channel is done and keeps its HV.
+    Steps are smaller than HV.MAX_STEP, so HV is never turned off
+    between set-points.
+    """
+    def __init__(self, channels, hv_min, hv_max,
+            coarse=COARSE_STEP, fine=FINE_STEP, growth=PLATEAU_GROWTH):
+        self.hv_max = hv_max
+        self.coarse = coarse
+        self.fine = fine
+        self.growth = growth
+        self.points = dict((chan, []) for chan in channels)  # [(hv, rate), ...]
+        self.queue = dict((chan, [hv_min]) for chan in channels)  # next set-points
+        self.plateau = {}  # {chan: the first coarse point on the plateau}
+    
+    def next(self):
+        """ Return {chan: hv} for channels which are not done. """
+        return dict((chan, q[0]) for chan, q in self.queue.items() if q)
+    
+    def update(self, rates):
+        """ Take rates {chan: rate} measured at the set-points from next(). """
+        for chan, hv_ in self.next().items():
+            queue = self.queue[chan]
+            queue.pop(0)
+            points = self.points[chan]
+            points.append((hv_, rates[chan]))
             
+            if chan in self.plateau:
+                continue  # fine steps are planned already
             
-            if prev_rates:
-                rate_rel = [round(abs(1-a/b),4) if b != 0 else 0 for a, b in zip(rates,prev_rates)]
-                sys.stderr.write("{}  \r".format(rate_rel))
-                
-                if all( [x<0.020 for x in rate_rel]) :
-                    break
-                
-            prev_rates = rates
+            if len(points) >= 2:
+                (hv_prev, prev), (_, rate) = points[-2:]
+                if prev >= MINIMAL_RATE and rate < prev * (1 + self.growth):
+                    # hv_prev is on the plateau, the knee is below it
+                    self.plateau[chan] = (hv_prev, prev)
+                    if len(points) >= 3:
+                        queue.extend(range(points[-3][0] + self.fine, hv_prev, self.fine))
+                    continue
             
-            if total_mtime > (1000 * 600):
+            if hv_ + self.coarse <= self.hv_max:
+                queue.append(hv_ + self.coarse)
+    
+    def knee(self, chan):
+        """ The lowest HV with the rate on the plateau (or None):
+        the rate grows from it to the first coarse point on the plateau
+        by less than `growth`, as well as from all points between them.
+        """
+        if chan not in self.plateau:
+            return None
+        hv_plateau, plateau = self.plateau[chan]
+        
+        ret = hv_plateau
+        for hv_, rate in sorted(self.points[chan], reverse=True):
+            if hv_ >= hv_plateau:
+                continue
+            if rate < MINIMAL_RATE or plateau >= rate * (1 + self.growth):
                 break
+            ret = hv_
+        return ret
 
-        return dict(zip(channels,rates))
+
+print_lock = threading.Lock()
+
+
+def measure(hv, adc, values, channels, args, prefix=''):
+    """ Set HV values {chan: hv}, measure rates of `channels` for each
+    threshold and print `chan threshold hv rate` until all the rates
+    are below MINIMAL_RATE.
+    Return rates {chan: rate} for the first threshold.
+    """
+    ret = None
+    
+    for idx, th_ in enumerate(threshold_range):
+        if idx == 0:
+            # separate devices, HV settles after set_values() returns
+            parallel((hv.set_values, values, False), (adc.set_thresholds, th_))
+        else:
+            adc.set_thresholds(th_)
+        hv.wait()
+        logger.info('{}HV {}, threshold {}'.format(prefix, values, th_))
+        logger.info(hv.connect())  # log HV status
+
+        rates = adc.measure_rates(channels, args.precision, args.max_time)
+        if ret is None:
+            ret = rates
+        
+        if all( [rates[chan] < MINIMAL_RATE for chan in channels]):
+            # move to next HV
+            break
         
+        with print_lock:
+            for chan in channels:
+                print prefix + str(chan), th_, hv.memory[chan], rates[chan], '  '
+            sys.stdout.flush()
+    
+    return ret
+
+
+def scan_grid(hv, adc, channels, args, prefix=''):
+    """ Measure all points of hv_range x threshold_range. """
+    for hv_ in hv_range:
+        measure(hv, adc, dict.fromkeys(channels, hv_), channels, args, prefix)
+
+
+def scan_plateau(hv, adc, channels, args, prefix=''):
+    """ Adaptive search of the rate plateau for each channel. """
+    planner = PlateauPlanner(channels, hv_range[0], hv_range[-1])
+    
+    while True:
+        values = planner.next()
+        if not values:
+            break
+        rates = measure(hv, adc, values, sorted(values), args, prefix)
+        planner.update(rates)
+    
+    for chan in channels:
+        logger.info('{}chan {}: plateau from {} V'.format(prefix, chan, planner.knee(chan)))
+
+
+def parse_addr(addr):
+    """ 'host:port' -> (host, port) """
+    host, port = addr.rsplit(':', 1)
+    return host, int(port)
+
 
 def main():
     global logger
@@ -284,41 +451,56 @@ def main():
     # --channels
     channels = range(0,16)
     
+    parser.add_argument('-p', '--precision', type=float, default=ADC.PRECISION,
+            help="target relative error of rates (%.2f by default)" % ADC.PRECISION)
+    
+    parser.add_argument('-t', '--max-time', type=float, default=ADC.MAX_TIME,
+            metavar='SEC',
+            help="max time of a rate measurement, common for all channels\n"
+                 "(%d s by default)" % ADC.MAX_TIME)
+    
+    parser.add_argument('-s', '--scan', choices=('plateau', 'grid'), default='plateau',
+            help="'plateau' -- adaptive search for each channel (default),\n"
+                 "'grid' -- all points of HV and threshold ranges")
+    
+    parser.add_argument('-c', '--crate', nargs=2, action='append',
+            metavar=('HV_HOST:PORT', 'ADC_HOST:PORT'),
+            help="HV unit and ADC of a crate, can be repeated to tune\n"
+                 "several crates at once (%s:%d %s:%d by default)" % (HV_ADDR + ADC_ADDR))
+    
     args = parser.parse_args()
     #~ print args
     
+    if sis3316 is None or HVUnit is None:
+        sys.stderr.write("{} (or use mock_devices.py)\n".format(import_error))
+        exit(1)
+    
     makedirs(OUTDIR)
     logger = setlog('hvtune', logfile=OUTDIR+'/log.log', console_lvl='DEBUG')
 
-    hv = HV(*HV_ADDR)
-    adc = ADC(*ADC_ADDR)
+    if args.crate:
+        crates = [map(parse_addr, addrs) for addrs in args.crate]
+    else:
+        crates = [(HV_ADDR, ADC_ADDR)]
     
-    logger.info( hv.connect())
-    logger.info( adc.connect())
+    units = []
+    for hv_addr, adc_addr in crates:
+        hv = HV(*hv_addr)
+        adc = ADC(*adc_addr)
+        logger.info( hv.connect())
+        logger.info( adc.connect())
+        units.append((hv, adc))
     
-    data = defaultdict(list)  # { (chan, threshold): [(hv, rate), ...] }
-    plots = {}  # { chan: plot }
+    scan = scan_grid if args.scan == 'grid' else scan_plateau
     
-    for hv_ in hv_range:
-        hv.set_all(hv_, channels=channels)
-        
-        for th_ in threshold_range:
-            adc.set_thresholds(th_)
-            logger.info('HV {}, threshold {}'.format(hv_, th_))
-            logger.info(hv.connect())  # log HV status
-
-            rates = adc.measure_rates(channels)
-            
-            if all( [r < MINIMAL_RATE for r in rates.values()]):
-                # move to next HV
-                break
-            
-            for chan, rate in rates.items():
-                print chan, th_, hv_, rate, '  '
-                sys.stdout.flush()
-                data[(chan, th_)].append((hv_, rate))
-        
-    hv.off()
+    # crates are tuned in parallel, each in its own thread
+    calls = []
+    for idx, (hv, adc) in enumerate(units):
+        prefix = '{} '.format(idx) if len(units) > 1 else ''
+        calls.append((scan, hv, adc, channels, args, prefix))
+    parallel(*calls)
+    
+    parallel(*[(hv.off,) for hv, adc in units])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Run hvtune.py with in-process mocks of HV units and SIS3316 ADCs.
+
+The mocks replace the classes hvctl.HVUnit and sis3316.Sis3316_udp and
+implement only the calls used by hvtune.py (v, z, set, on/off; thresholds,
+mem_toggle, poll_act). Event rates follow a model: a logistic curve of HV
+with a random knee for each channel, falling exponentially with the
+threshold. Commands have a latency and fail with socket.timeout with
+a given probability. Time runs --speedup times faster, so a scan takes
+seconds.
+
+Not covered: there are no TCP/UDP servers, so the code of hvctl and
+sis3316 (wire protocols, sockets, lost or reordered UDP packets, real
+register values) is not run; the HV unit ramps linearly during HV_DELAY.
+
+The HV unit and the ADC with the same host belong to the same crate.
+Options not listed here are passed to hvtune.py, for example:
+  ./mock_devices.py --speedup 1000 --scan grid
+  ./mock_devices.py -c 10.0.0.1:2217 10.0.0.1:2223 -c 10.0.0.2:2217 10.0.0.2:2223
+"""
+
+import sys
+import time
+import math
+import random
+import socket
+import argparse
+import threading
+
+import util
+import hvtune
+
+SPEEDUP = 100
+LATENCY = 0.005  # seconds per command
+FAULTS = 0.0  # probability of a command timeout
+
+KNEE = (2150, 2450)  # V, knees of channels are uniform in this range
+KNEE_WIDTH = 30  # V
+PLATEAU_RATE = (20.0, 80.0)  # events per second
+THRESHOLD_SCALE = 30.0  # the rate falls e times per THRESHOLD_SCALE
+THRESHOLD_REF = 60
+NOISE_RATE = 0.2  # events per second at zero HV
+
+
+def poisson(mean):
+    if mean > 100:
+        return max(0, int(round(random.gauss(mean, math.sqrt(mean)))))
+    limit, k, p = math.exp(-mean), 0, random.random()
+    while p > limit:
+        k += 1
+        p *= random.random()
+    return k
+
+
+class Clock(object):
+    """ Time which runs `speedup` times faster. """
+    def __init__(self, speedup=SPEEDUP):
+        self.speedup = float(speedup)
+        self.start = time.time()
+
+    def time(self):
+        return self.start + (time.time() - self.start) * self.speedup
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0) / self.speedup)
+
+
+clock = Clock()
+
+
+class Crate(object):
+    """ Simulated detector: HV values and event rates of channels. """
+    crates = {}  # {host: Crate}
+    lock = threading.Lock()
+
+    def __init__(self, seed):
+        rnd = random.Random(seed)
+        self.knee = [rnd.uniform(*KNEE) for _ in range(16)]
+        self.plateau = [rnd.uniform(*PLATEAU_RATE) for _ in range(16)]
+        self.hv = {}  # {chan: value}
+        self.on_time = None  # when HV was turned on
+        self.off_time = None
+        self.thresholds = [0] * 16
+
+    @classmethod
+    def get(cls, host):
+        with cls.lock:
+            if host not in cls.crates:
+                cls.crates[host] = Crate(host)
+            return cls.crates[host]
+
+    def voltage(self, chan):
+        """ The actual HV of a channel (it rises and falls during HV_DELAY). """
+        value = self.hv.get(chan, 0)
+        delay = hvtune.HV.HV_DELAY
+        if self.on_time is not None:
+            return value * min(1.0, (clock.time() - self.on_time) / delay)
+        if self.off_time is not None:
+            return value * max(0.0, 1 - (clock.time() - self.off_time) / delay)
+        return 0.0
+
+    def rate(self, chan):
+        hv = self.voltage(chan)
+        signal = self.plateau[chan] / (1 + math.exp(-(hv - self.knee[chan]) / KNEE_WIDTH))
+        th = self.thresholds[chan] - THRESHOLD_REF
+        return (signal + NOISE_RATE) * math.exp(-th / THRESHOLD_SCALE)
+
+
+class Device(object):
+    latency = LATENCY
+    faults = FAULTS
+
+    def command(self):
+        """ Delay of a command, may fail. """
+        clock.sleep(self.latency)
+        if random.random() < self.faults:
+            raise socket.timeout('simulated timeout')
+
+
+class MockHVUnit(Device):
+    """ hvctl.HVUnit """
+    def __init__(self, host='localhost', port=2217):
+        self.crate = Crate.get(host)
+        self.chans = dict((v, k) for k, v in hvtune.HV_CHANS.items())  # HV chan -> chan
+
+    def cmd(self, command):
+        self.command()
+        crate = self.crate
+        if command == 'z':
+            crate.hv.clear()
+            return 'ok\n'
+        if command == 'v':
+            return 'V {:.0f}\n'.format(max([crate.voltage(c) for c in range(16)]))
+        raise ValueError('unknown command {}'.format(command))
+
+    def v(self):
+        return {'V': self.cmd('v').split()[1]}
+
+    def set(self, hv_chan, value):
+        self.command()
+        self.crate.hv[self.chans[hv_chan]] = value
+
+    def on(self):
+        self.command()
+        if self.crate.on_time is None:
+            self.crate.on_time = clock.time()
+            self.crate.off_time = None
+
+    def off(self):
+        self.command()
+        if self.crate.on_time is not None:
+            self.crate.on_time = None
+            self.crate.off_time = clock.time()
+
+
+class MockTrigger(object):
+    def __init__(self, adc, chan):
+        self.adc = adc
+        self.chan = chan
+
+    @property
+    def threshold(self):
+        self.adc.command()
+        return 0x8000000 + self.adc.crate.thresholds[self.chan]
+
+    @threshold.setter
+    def threshold(self, value):
+        self.adc.command()
+        self.adc.crate.thresholds[self.chan] = value - 0x8000000
+
+
+class MockChannel(object):
+    def __init__(self, adc, chan):
+        self.trig = MockTrigger(adc, chan)
+
+
+class MockSis3316(Device):
+    """ sis3316.Sis3316_udp """
+    id = 0x3316
+    temp = 30
+
+    def __init__(self, host='localhost', port=3344):
+        self.crate = Crate.get(host)
+        self.serno = hash(host) & 0xffff
+        self.chan = [MockChannel(self, ch) for ch in range(16)]
+        self.default_timeout = 1.0
+        self.counts = [0.0] * 16
+        self.last = None
+
+    def open(self):
+        self.command()
+
+    def configure(self):
+        self.command()
+
+    def _count(self):
+        """ Events since the last call (Poisson), the rates are taken now. """
+        t = clock.time()
+        dt = t - self.last
+        self.last = t
+        for ch in range(16):
+            self.counts[ch] += poisson(self.crate.rate(ch) * dt)
+
+    def mem_toggle(self):
+        self.command()
+        self.counts = [0.0] * 16
+        self.last = clock.time()
+
+    def poll_act(self, chans):
+        """ Bytes in memory for `chans` since mem_toggle(). """
+        self.command()
+        self._count()
+        return [int(self.counts[ch]) * hvtune.EVENT_SZ for ch in chans]
+
+
+class MockModule(object):
+    """ Instead of sis3316 module. """
+    Sis3316_udp = MockSis3316
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+
+    parser.add_argument('--speedup', type=float, default=SPEEDUP,
+            help="simulated time runs faster (%d by default)" % SPEEDUP)
+
+    parser.add_argument('--latency', type=float, default=LATENCY,
+            metavar='SEC',
+            help="command latency (%.3f s by default)" % LATENCY)
+
+    parser.add_argument('--faults', type=float, default=FAULTS,
+            metavar='P',
+            help="probability of a command timeout (%.2f by default)" % FAULTS)
+
+    parser.add_argument('--seed', type=int, default=None,
+            help="random seed for events and faults")
+
+    parser.add_argument('--sim-help', action='help',
+            help="show this help message and exit")
+
+    args, rest = parser.parse_known_args()
+
+    random.seed(args.seed)
+    clock.speedup = args.speedup
+    Device.latency = args.latency
+    Device.faults = args.faults
+
+    hvtune.HVUnit = MockHVUnit
+    hvtune.sis3316 = MockModule
+    hvtune.now = clock.time
+    hvtune.sleep = clock.sleep
+    util.sleep = clock.sleep  # retry delays
+
+    sys.argv = [hvtune.__file__] + rest
+    start, real_start = clock.time(), time.time()
+
+    hvtune.main()
+
+    sys.stderr.write("\nsimulated time: {:.0f} s, real time: {:.1f} s\n".format(
+            clock.time() - start, time.time() - real_start))
+    for host, crate in sorted(Crate.crates.items()):
+        sys.stderr.write("crate {}, knees: {}\n".format(host,
+                ' '.join('{:.0f}'.format(k) for k in crate.knee)))
+
+
+if __name__ == "__main__":
+    main()
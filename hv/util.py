@@ -5,6 +5,8 @@
 import os
 import logging
 import re
+import sys
+import threading
 from time import sleep
 
 
@@ -114,3 +116,37 @@ def retry(max_tries, delay=1, backoff=2, exceptions=(Exception,), hook=None):
                     break
         return f2
     return dec
+
+
+class Future(object):
+    """ Call a function in a background thread.
+    result() waits for it and returns its value (or raises its exception).
+    """
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self):
+        while self._thread.is_alive():
+            self._thread.join(0.5)  # keep Ctrl+C working
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+def parallel(*calls):
+    """ Run calls (func, arg1, arg2, ...) in threads, return their results. """
+    futures = [Future(*call) for call in calls]
+    return [f.result() for f in futures]
@@ -0,0 +1,100 @@
+"""
+    Landau convoluted with Gauss, vectorized with numpy.
+
+    The same function as `langaufun` in mylangaus.cxx (which is
+    evaluated by ROOT point by point), but for arrays of values.
+"""
+
+import numpy as np
+
+# CERNLIB DENLAN approximation (the same as in TMath::Landau)
+_P1 = (0.4259894875, -0.1249762550, 0.03984243700, -0.006298287635, 0.001511162253)
+_Q1 = (1.0, -0.3388260629, 0.09594393323, -0.01608042283, 0.003778942063)
+_P2 = (0.1788541609, 0.1173957403, 0.01488850518, -0.001394989411, 0.0001283617211)
+_Q2 = (1.0, 0.7428795082, 0.3153932961, 0.06694219548, 0.008790609714)
+_P3 = (0.1788544503, 0.09359161662, 0.006325387654, 0.00006611667319, -0.000002031049101)
+_Q3 = (1.0, 0.6097809921, 0.2560616665, 0.04746722384, 0.006957301675)
+_P4 = (0.9874054407, 118.6723273, 849.2794360, -743.7792444, 427.0262186)
+_Q4 = (1.0, 106.8615961, 337.6496214, 2016.712389, 1597.063511)
+_P5 = (1.003675074, 167.5702434, 4789.711289, 21217.86767, -22324.94910)
+_Q5 = (1.0, 156.9424537, 3745.310488, 9834.698876, 66924.28357)
+_P6 = (1.000827619, 664.9143136, 62972.92665, 475554.6998, -5743609.109)
+_Q6 = (1.0, 651.4101098, 56974.73333, 165917.4725, -2815759.939)
+_A1 = (0.04166666667, -0.01996527778, 0.02709538966)
+_A2 = (-1.845568670, -4.284640743)
+
+INVSQ2PI = 0.3989422804014  # (2 pi)^(-1/2)
+MPSHIFT = -0.22278298  # Landau maximum location
+
+CONV_NP = 100  # number of convolution steps
+CONV_SC = 5.0  # convolution extends to +-sc Gaussian sigmas
+
+
+def _ratio(p, q, v):
+    num = p[0] + (p[1] + (p[2] + (p[3] + p[4] * v) * v) * v) * v
+    den = q[0] + (q[1] + (q[2] + (q[3] + q[4] * v) * v) * v) * v
+    return num / den
+
+
+def denlan(v):
+    """ Landau density with location 0 and scale 1 (CERNLIB DENLAN). """
+    v = np.asarray(v, dtype=float)
+    ret = np.zeros_like(v)
+
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        m = v < -5.5
+        u = np.exp(v[m] + 1.0)
+        ue = np.exp(-1 / u)
+        ret[m] = np.where(u < 1e-10, 0.0, INVSQ2PI * (ue / np.sqrt(u))
+                * (1 + (_A1[0] + (_A1[1] + _A1[2] * u) * u) * u))
+
+        m = (v >= -5.5) & (v < -1)
+        u = np.exp(-v[m] - 1)
+        ret[m] = np.exp(-u) * np.sqrt(u) * _ratio(_P1, _Q1, v[m])
+
+        m = (v >= -1) & (v < 1)
+        ret[m] = _ratio(_P2, _Q2, v[m])
+
+        m = (v >= 1) & (v < 5)
+        ret[m] = _ratio(_P3, _Q3, v[m])
+
+        for lo, hi, p, q in ((5, 12, _P4, _Q4), (12, 50, _P5, _Q5), (50, 300, _P6, _Q6)):
+            m = (v >= lo) & (v < hi)
+            u = 1 / v[m]
+            ret[m] = u * u * _ratio(p, q, u)
+
+        m = v >= 300
+        u = 1 / (v[m] - v[m] * np.log(v[m]) / (v[m] + 1))
+        ret[m] = u * u * (1 + (_A2[0] + _A2[1] * u) * u)
+
+    return ret
+
+
+def langaus(x, width, mpv, area, sigma):
+    """ Landau (`width`, `mpv`) convoluted with Gauss (`sigma`),
+        normalized to `area`. See mylangaus.cxx for details.
+    """
+    x = np.asarray(x, dtype=float)
+    if width <= 0 or sigma <= 0:
+        return np.zeros_like(x)
+
+    mpc = mpv - MPSHIFT * width
+
+    step = 2 * CONV_SC * sigma / CONV_NP
+    offsets = (np.arange(CONV_NP) + 0.5) * step - CONV_SC * sigma
+
+    xx = x[..., np.newaxis] + offsets  # convolution points
+    fland = denlan((xx - mpc) / width) / width
+    gaus = np.exp(-0.5 * (offsets / sigma) ** 2)
+    summ = (fland * gaus).sum(axis=-1)
+
+    return area * step * summ * INVSQ2PI / sigma
+
+
+def langaus_exp(x, params):
+    """ The same function as LANGAUS_FUNC in rootfit_cosmics.py:
+        langauss + exponential noize.
+    """
+    width, mpv, area, sigma, exp_a, exp_b = params
+    return (langaus(x, width, mpv, area, sigma)
+            + 0.001 * exp_a * np.exp(-0.0001 * exp_b * np.asarray(x, dtype=float)))
@@ -3,11 +3,20 @@
 """
 Fit monitoring system data, find peak value.
 (fits around the maximum)
+
+Single file mode: fit values in COL_IDX column, plot the histogram.
+Batch mode (--batch): fit each channel of each file in time slices
+in a pool of processes, print a table:
+  file chan slice ts n mu mu_err sigma sigma_err
 """
 
 import sys
 import os
+import argparse
+import multiprocessing
+from collections import deque
 import numpy as np
+import pandas as pd
 from scipy.optimize import curve_fit
 
 # ------------ Parameters -----------------
@@ -17,68 +26,178 @@ COL_IDX = 2  # which column contains values, starting from 0
 NBINS = 100  # a number of bins for the histogram
 RANGE = (2000, 10000)
 
+TS_COL, CHAN_COL = 0, 1  # for batch mode
+HZ = 250 * 1000 * 1000  # ts = time * HZ
+MIN_COUNT = 100  # do not fit slices with less values
+
 # -----------------------------------------
 
-if len(sys.argv) != 2:
-    sys.stderr.write("USAGE: %s <datafile.txt>\n" % sys.argv[0])
-    exit(1)
-
-filename = sys.argv[1]
-if not os.path.isfile(filename):
-    sys.stderr.write("No such file: '%s'\n" % filename)
-    exit(1)
-    
-loaded = np.loadtxt(filename, usecols=(COL_IDX,) )
-data = loaded[loaded>THRESHOLD]  # filter data
-
-#~ print 'N:', len(data), 'FILTERED:', len(loaded) - len(data)
-#~ del loaded  # free some memory
-
-hist, bin_edges = np.histogram(data, bins=NBINS, range = RANGE)
-bin_centres = (bin_edges[:-1] + bin_edges[1:])/2
-bin_cnt = len(bin_centres)
-max_y = max(hist)
-max_index = hist.argmax()
-max_x = bin_centres[max_index]
-
-#~ print 'max_x', max_x
-
-# Filter the histogram 
-bin_width = bin_cnt - max_index
-bin_left = max_index - bin_width/6
-hist2 = hist[bin_left: bin_cnt]
-bin_centres2 = bin_centres[bin_left: bin_cnt]
-bin_edges2 = bin_edges[bin_left: bin_cnt]
 
 def gauss(x, *p):
     A, mu, sigma = p
     return A*np.exp(-(x-mu)**2/(2.*sigma**2))
-    
-# p0 is the initial guess for the fitting coefficients (A, mu and sigma above)
-p0 = [max_y, max_x, 100.]
-
-# Fit the histogram
-coeff, var_matrix = curve_fit(gauss, bin_centres2, hist2, p0=p0)
-var_error = np.sqrt(np.diag(var_matrix))
-
-result = zip(coeff, var_error)
-#~ print result
-mpl, mpl_std = result[1]
-mpl_str = u"{:.2f} ± {:.2f}".format(*result[1])
-sigma_str = u"{:.2f} ± {:.2f}".format(*result[2])
-
-result_str = u"{}\t{}\t{}".format(filename, mpl_str, sigma_str)
-
-print(result_str.encode('utf-8').strip())
-#: Uncomment to plot the histogram and the fit
-import matplotlib.pyplot as plt
-hist_fit = gauss(bin_centres2, *coeff)
-plt.step(bin_centres, hist, where='mid', label='Data')
-plt.plot(bin_centres2, hist_fit, label="Fit")
-plt.axvline(mpl+mpl_std, color='red', label=u"Peak: %s" % mpl_str)
-
-plt.axvline(mpl-mpl_std, color='red')
-plt.title(filename)
-plt.legend(loc='upper left')
-plt.grid()
-plt.show()
+
+
+def fit_peak(data):
+    """ Fit the histogram of `data` with Gauss around the maximum.
+        Return coefficients (A, mu, sigma), their errors and
+        the histogram (bin_centres, hist, fitted range).
+    """
+    data = data[data>THRESHOLD]  # filter data
+
+    hist, bin_edges = np.histogram(data, bins=NBINS, range = RANGE)
+    if not hist.any():
+        raise ValueError('no values in range {}'.format(RANGE))
+
+    bin_centres = (bin_edges[:-1] + bin_edges[1:])/2
+    bin_cnt = len(bin_centres)
+    max_y = max(hist)
+    max_index = hist.argmax()
+    max_x = bin_centres[max_index]
+
+    # Filter the histogram
+    bin_width = bin_cnt - max_index
+    bin_left = max(0, max_index - bin_width//6)
+    hist2 = hist[bin_left: bin_cnt]
+    bin_centres2 = bin_centres[bin_left: bin_cnt]
+
+    # p0 is the initial guess for the fitting coefficients (A, mu and sigma above)
+    p0 = [max_y, max_x, 100.]
+    if len(hist2) < len(p0):  # the maximum is at the right edge
+        raise ValueError('{} bins to fit'.format(len(hist2)))
+
+    # Fit the histogram
+    coeff, var_matrix = curve_fit(gauss, bin_centres2, hist2, p0=p0)
+    var_error = np.sqrt(np.diag(var_matrix))
+
+    return coeff, var_error, (bin_centres, hist, bin_centres2)
+
+
+def _fit_task(task):
+    """ Fit one slice (in a worker process). """
+    key, data = task
+    try:
+        coeff, var_error, _ = fit_peak(data)
+    except (RuntimeError, ValueError, TypeError) as e:  # no convergence or no data
+        filename, chan, slc, ts = key
+        sys.stderr.write('{} chan {} slice {}: {}\n'.format(filename, chan, slc, e))
+        coeff, var_error = [np.nan] * 3, [np.nan] * 3
+    return key, len(data), coeff, var_error
+
+
+def batch_tasks(filenames, slice_sec):
+    """ Generator. Load files one by one, yield (key, values) for each
+        channel and time slice, key is (filename, chan, slice, ts).
+    """
+    usecols = (TS_COL, CHAN_COL, COL_IDX)
+
+    for filename in filenames:
+        loaded = pd.read_csv(filename, delim_whitespace=True, header=None,
+                comment='#', usecols=usecols)
+
+        ts = loaded[TS_COL].values.astype(float)
+        if slice_sec:
+            slices = ((ts - ts.min()) // (slice_sec * HZ)).astype(int)
+        else:
+            slices = np.zeros(len(ts), dtype=int)
+        loaded['slice'] = slices
+
+        for (chan, slc), group in loaded.groupby([CHAN_COL, 'slice']):
+            if len(group) < MIN_COUNT:
+                continue
+            key = (filename, chan, slc, group[TS_COL].min())
+            yield key, group[COL_IDX].values.astype(float)
+
+
+def print_fit(key, n, coeff, err):
+    filename, chan, slc, ts = key
+    print('{}\t{}\t{}\t{:.0f}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}'.format(
+            filename, chan, slc, ts, n,
+            coeff[1], err[1], abs(coeff[2]), err[2]))
+    sys.stdout.flush()
+
+
+def batch(filenames, slice_sec, jobs):
+    pool = multiprocessing.Pool(jobs)
+
+    print('\t'.join(('file', 'chan', 'slice', 'ts', 'n',
+            'mu', 'mu_err', 'sigma', 'sigma_err')))
+
+    # pool.imap would read all the files ahead, keep about `jobs` slices in flight
+    pending = deque()
+    for task in batch_tasks(filenames, slice_sec):
+        pending.append(pool.apply_async(_fit_task, (task,)))
+        if len(pending) > jobs:
+            print_fit(*pending.popleft().get())
+
+    while pending:
+        print_fit(*pending.popleft().get())
+
+    pool.close()
+    pool.join()
+
+
+def single(filename):
+    loaded = np.loadtxt(filename, usecols=(COL_IDX,) )
+    coeff, var_error, (bin_centres, hist, bin_centres2) = fit_peak(loaded)
+
+    result = zip(coeff, var_error)
+    #~ print result
+    mpl, mpl_std = result[1]
+    mpl_str = u"{:.2f} ± {:.2f}".format(*result[1])
+    sigma_str = u"{:.2f} ± {:.2f}".format(*result[2])
+
+    result_str = u"{}\t{}\t{}".format(filename, mpl_str, sigma_str)
+
+    print(result_str.encode('utf-8').strip())
+    #: Uncomment to plot the histogram and the fit
+    import matplotlib.pyplot as plt
+    hist_fit = gauss(bin_centres2, *coeff)
+    plt.step(bin_centres, hist, where='mid', label='Data')
+    plt.plot(bin_centres2, hist_fit, label="Fit")
+    plt.axvline(mpl+mpl_std, color='red', label=u"Peak: %s" % mpl_str)
+
+    plt.axvline(mpl-mpl_std, color='red')
+    plt.title(filename)
+    plt.legend(loc='upper left')
+    plt.grid()
+    plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('infiles', nargs='+', metavar='datafile.txt')
+
+    parser.add_argument('--batch', action='store_true',
+            help='fit each channel and time slice of all files, no plots')
+
+    parser.add_argument('-s', '--slice', type=float, default=0,
+            metavar='SEC',
+            help='time slice in seconds for --batch (whole file by default)')
+
+    parser.add_argument('-j', '--jobs', type=int,
+            default=multiprocessing.cpu_count(),
+            help='a number of processes (number of CPUs by default)')
+
+    args = parser.parse_args()
+
+    for filename in args.infiles:
+        if not os.path.isfile(filename):
+            sys.stderr.write("No such file: '%s'\n" % filename)
+            exit(1)
+
+    if args.batch:
+        batch(args.infiles, args.slice, args.jobs)
+
+    elif len(args.infiles) != 1:
+        sys.stderr.write("Only one file without --batch.\n")
+        exit(1)
+
+    else:
+        single(args.infiles[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,24 @@
 """
 Adjust values according to monitoring system data.
 
+Correction factors are linearly interpolated between monitoring points
+(or taken from the next monitoring point with --interp step)
+for each channel; the data are processed in chunks.
+
+Monitoring data can be a gain drift model file made by monsys_model.py
+(*.npz), it is loaded instantly and evaluated at any timestamp.
+
+Usage: monsys_adjust.py data.txt mon_reduced1000.txt > data_adj.txt
+       monsys_adjust.py data.txt mon_model.npz > data_adj.txt
 """
 
 import sys
+import argparse
 import numpy as np
+import pandas as pd
+
+from smoothing import METHODS, RollingMean, smooth_array
+from monsys_model import load_model
 
 MFILE_TS_COL = 0
 MFILE_CHAN_COL = 1
@@ -17,6 +31,9 @@ DFILE_TS_COL = 0
 DFILE_CHAN_COL = 1
 DFILE_VAL_COL = 2
 
+CHUNKSIZE = 1000 * 1000  # lines
+OUT_FORMAT = '%.0f %d %.2f %.2f'  # ts chan adjval val
+
 
 def get_mondata(fd):
     """ Generator. Next data from mfile.
@@ -43,42 +60,113 @@ def avg_mondata(fd):
         Average MBACKLOG values.
     """
     md = get_mondata(fd)
+    smoother = RollingMean(MBACKLOG)
     
     data = {}
     for ts, mdata in md:
         for chan, val in mdata.items():
-            try:
-                data[chan].append(val)
-            except KeyError:
-                data[chan] = []
-                data[chan].append(val)
+            data[chan] = smoother.update(chan, val)
+        yield ts, dict(data)
+
+def load_mondata(filename, smooth=None, window=MBACKLOG):
+    """ Load monitoring data, smooth it with `smooth` method (if any).
+        Return a dict {chan: (timestamps, values)}, sorted by timestamps.
+    """
+    loaded = pd.read_csv(filename, delim_whitespace=True, header=None,
+            comment='#', usecols=(MFILE_TS_COL, MFILE_CHAN_COL, MFILE_VAL_COL))
+
+    ret = {}
+    for chan, group in loaded.groupby(MFILE_CHAN_COL):
+        group = group.sort_values(MFILE_TS_COL)
+        vals = group[MFILE_VAL_COL].values.astype(float)
+        if smooth:
+            vals = smooth_array(vals, smooth, window)
+        ret[chan] = (group[MFILE_TS_COL].values.astype(float), vals)
+    return ret
+
+
+def mon_factors(ts, chans, mondata, interp='linear'):
+    """ Return correction factors for records (`ts`, `chans`):
+        monitoring value at ts / the first monitoring value.
+        NaN for channels without monitoring data.
+    """
+    factors = np.full(len(ts), np.nan)
 
-            if len(data[chan]) > MBACKLOG:
-                data[chan].pop(0)
+    for chan in np.unique(chans):
+        if chan not in mondata:
+            continue
 
-        yield ts, dict( [ (chan, sum(vals)/len(vals)) for chan, vals in data.items()])
+        mts, mvals = mondata[chan]
+        sel = chans == chan
 
-dfile = open(sys.argv[1], 'ro')
-mfile = open(sys.argv[2], 'ro')
+        if interp == 'step':  # the next monitoring point
+            idx = np.searchsorted(mts, ts[sel], side='left')
+            mval = mvals[np.minimum(idx, len(mvals) - 1)]
+        else:
+            mval = np.interp(ts[sel], mts, mvals)
 
-md = get_mondata(mfile)
+        factors[sel] = mval / mvals[0]
 
+    return factors
 
-mts, mdata = next(md)
 
-mdata0 = mdata
+def adjust(infile, get_factors, outfile, chunksize=CHUNKSIZE):
+    """ Read data records from `infile` by chunks,
+        write adjusted records to `outfile`.
+        get_factors(ts, chans) returns correction factors (NaN to skip).
+    """
+    reader = pd.read_csv(infile, delim_whitespace=True, header=None,
+            comment='#', usecols=(DFILE_TS_COL, DFILE_CHAN_COL, DFILE_VAL_COL),
+            chunksize=chunksize)
 
-for line in dfile:
-    vals = line.split()
-    ts = float(vals[DFILE_TS_COL])
-    chan = vals[DFILE_CHAN_COL]
-    val = float(vals[DFILE_VAL_COL])
-    
-    while ts > mts:
-        mts, mdata = next(md)
+    for chunk in reader:
+        ts = chunk[DFILE_TS_COL].values.astype(float)
+        chans = chunk[DFILE_CHAN_COL].values
+        vals = chunk[DFILE_VAL_COL].values.astype(float)
+
+        factors = get_factors(ts, chans)
+        ok = np.isfinite(factors)
+
+        out = np.column_stack((ts[ok], chans[ok], vals[ok] * factors[ok], vals[ok]))
+        np.savetxt(outfile, out, fmt=OUT_FORMAT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('dfile', help='a file with data records')
+    parser.add_argument('mfile', help='a file with monitoring data'
+            ' or a drift model (*.npz)')
+
+    parser.add_argument('--interp',
+            choices=('linear', 'step'),
+            default='linear',
+            help="interpolation between monitoring points ('linear' by default)"
+            )
+
+    parser.add_argument('--smooth',
+            choices=METHODS,
+            help="smooth monitoring data per channel"
+            )
+
+    parser.add_argument('--window',
+            type=int,
+            default=MBACKLOG,
+            help="a number of monitoring points to smooth"
+                " (%d by default)" % MBACKLOG
+            )
+
+    args = parser.parse_args()
+
+    if args.mfile.endswith('.npz'):
+        get_factors = load_model(args.mfile).factors
+    else:
+        mondata = load_mondata(args.mfile, smooth=args.smooth, window=args.window)
+        get_factors = lambda ts, chans: mon_factors(ts, chans, mondata, args.interp)
+
+    adjust(args.dfile, get_factors, sys.stdout)
 
-#    print "TS {:.0f} {:.0f} {:.0f}".format(ts, mts, mts-ts)
 
-    if chan in mdata and chan in mdata0:
-        adjval = val * mdata[chan]/mdata0[chan]
-        print '{:.0f} {} {:.2f} {:.2f}'.format(ts, chan, adjval, val)
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,160 @@
 #!/usr/bin/env python
+"""
+Average monitoring system pulses for each series of pulses and channel.
+
+Series are separated by gaps of more than TS_GAP in timestamps.
+For each series and channel with 50..150 pulses above THRESHOLD
+print the mean and std of the values between 10 and 90 percentiles.
+
+Output columns: <ts of the last pulse> <chan> <mean> <std> <count>
+"""
 
 import sys
+import argparse
 import numpy as np
+import pandas as pd
 
-filename = sys.argv[1]
-fd = open(filename,'ro')
+from smoothing import METHODS, make_smoother
 
 TS_COL, CHAN_COL, VAL_COL = 0, 1, 2
 
 HZ = 250*1000*1000  # ts = time * HZ
 TS_GAP = 1 * HZ  # sec. (minimal gap between series of pulses)
 THRESHOLD = 800
+MIN_PULSES, MAX_PULSES = 50, 150  # per series and channel
+PERCENTILES = (10, 90)  # average values between these percentiles
+SMOOTH_WINDOW = 10  # series
+
+CHUNKSIZE = 1000 * 1000  # lines
+OUT_FORMAT = '%.0f %d %.2f %.3f %d'
+
+
+def group_percentile(vals, starts, counts, q):
+    """ Percentile `q` (linear interpolation, like np.percentile)
+        for each group of sorted `vals` given by `starts` and `counts`.
+    """
+    h = (counts - 1) * q / 100.0
+    lo = np.floor(h).astype(int)
+    hi = np.minimum(lo + 1, counts - 1)
+    return vals[starts + lo] + (h - lo) * (vals[starts + hi] - vals[starts + lo])
+
+
+def series_stats(ts, chans, vals, series):
+    """ Trimmed statistics for each (series, chan) group.
+        `series` is a series number for each record.
+        Return an array of rows (ts, chan, mean, std, count).
+    """
+    # the last timestamp of each series (records are ordered by ts)
+    first = series[0]
+    last = np.flatnonzero(np.append(series[1:] != series[:-1], True))
+    series_ts = np.zeros(series[-1] - first + 1)
+    series_ts[series[last] - first] = ts[last]
+
+    order = np.lexsort((vals, chans, series))
+    chans, vals, series = chans[order], vals[order], series[order]
+
+    # group boundaries
+    newgroup = np.ones(len(vals), dtype=bool)
+    newgroup[1:] = (series[1:] != series[:-1]) | (chans[1:] != chans[:-1])
+    starts = np.flatnonzero(newgroup)
+    counts = np.diff(np.append(starts, len(vals)))
+
+    ok = (counts >= MIN_PULSES) & (counts <= MAX_PULSES)
+    v = vals[np.repeat(ok, counts)]  # records of good groups
+    starts, counts = starts[ok], counts[ok]
+    if not len(starts):
+        return np.empty((0, 5))
+
+    lo = group_percentile(vals, starts, counts, PERCENTILES[0])
+    hi = group_percentile(vals, starts, counts, PERCENTILES[1])
+
+    gidx = np.repeat(np.arange(len(starts)), counts)
+    inside = (v > lo[gidx]) & (v < hi[gidx])
+    gidx, v = gidx[inside], v[inside]
+
+    n = np.bincount(gidx, minlength=len(starts))
+    summ = np.bincount(gidx, v, minlength=len(starts))
+    nonzero = n > 0
+    mean = np.zeros(len(starts))
+    mean[nonzero] = summ[nonzero] / n[nonzero]
+    sqdev = np.bincount(gidx, (v - mean[gidx]) ** 2, minlength=len(starts))
+    std = np.zeros(len(starts))
+    std[nonzero] = np.sqrt(sqdev[nonzero] / n[nonzero])
+
+    ts_out = series_ts[series[starts] - first]
+    rows = np.column_stack((ts_out, chans[starts], mean, std, n))
+    return rows[nonzero]
+
+
+def read_series(filename, chunksize=CHUNKSIZE):
+    """ Generator. Read records by chunks, yield (ts, chans, vals, series)
+        for complete series of pulses.
+    """
+    reader = pd.read_csv(filename, delim_whitespace=True, header=None,
+            comment='#', usecols=(TS_COL, CHAN_COL, VAL_COL),
+            chunksize=chunksize)
+
+    tail = None  # records of the last (incomplete) series
+    series0 = 0
+
+    for chunk in reader:
+        chunk = chunk[chunk[VAL_COL] >= THRESHOLD]
+        ts = chunk[TS_COL].values.astype(float)
+        chans = chunk[CHAN_COL].values
+        vals = chunk[VAL_COL].values.astype(float)
+
+        if tail is not None:
+            ts = np.concatenate((tail[0], ts))
+            chans = np.concatenate((tail[1], chans))
+            vals = np.concatenate((tail[2], vals))
+
+        if not len(ts):
+            continue
 
-data = {}
+        series = series0 + np.concatenate(([0], np.cumsum(np.diff(ts) > TS_GAP)))
+        complete = series < series[-1]
 
-def print_data(ts, data):
-    tssec = ts/HZ
+        if complete.any():
+            yield ts[complete], chans[complete], vals[complete], series[complete]
 
-    #if len(data) < 6: 
-    #    return 
+        rest = ~complete
+        tail = ts[rest], chans[rest], vals[rest]
+        series0 = series[-1]
 
-    for chan, values in data.items():
+    if tail is not None and len(tail[0]):
+        yield tail + (np.full(len(tail[0]), series0),)
 
-        if len(values) > 150 or len(values) < 50:
-            continue
-        arr = np.array(values)
-        range_ = np.percentile(arr, [10 ,90])
-        rarr = arr[(arr> range_[0]) & (arr<range_[1])]
 
-       
-        if len(rarr):
-            #print '{:.0f} {} {:.2f} {:.3f} {}'.format(ts, chan, np.average(rarr), np.std(rarr), len(rarr))
-            print '{:.0f} {} {:.2f} {:.3f} {}'.format(ts, chan, np.average(rarr), np.std(rarr), len(rarr))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter)
 
+    parser.add_argument('infile', help='monitoring system pulses (records)')
 
-ts_prev = None
+    parser.add_argument('--smooth',
+            choices=METHODS,
+            help="smooth averages of series per channel"
+            )
 
-for line in fd:
-    
-    values = line.split()
-    ts = int(values[TS_COL])
-    chan = values[CHAN_COL]
-    val = float(values[VAL_COL])
+    parser.add_argument('--window',
+            type=int,
+            default=SMOOTH_WINDOW,
+            help="a number of series to smooth"
+                " (%d by default)" % SMOOTH_WINDOW
+            )
 
+    args = parser.parse_args()
+    smoother = make_smoother(args.smooth, args.window) if args.smooth else None
 
-    if val < THRESHOLD:
-        continue
+    for ts, chans, vals, series in read_series(args.infile):
+        rows = series_stats(ts, chans, vals, series)
 
-    try:
-        data[chan].append(val)
-    except KeyError:
-        data[chan] = []
-        data[chan].append(val)
+        if smoother:
+            for row in rows:
+                row[2] = smoother.update(row[1], row[2])
 
-    if ts_prev and ts - ts_prev > TS_GAP:
-        # a new series of pulses 
-	#print 'PRDATA', ts, data.keys()
-        print_data(ts, data)
-        data = {}
+        np.savetxt(sys.stdout, rows, fmt=OUT_FORMAT)
 
-    ts_prev = ts
 
+if __name__ == "__main__":
+    main()
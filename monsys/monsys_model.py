@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fit a smooth gain drift model to monitoring data.
+
+For each channel fit a cubic spline (least squares, knots every
+--knot seconds, placed at quantiles of timestamps) and save spline
+coefficients to a small binary .npz file. monsys_adjust.py accepts
+this file instead of a text file with monitoring data.
+
+Usage: monsys_model.py mon_avg.txt -o mon_model.npz
+"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.interpolate import splrep, splev
+
+# ------------ Parameters -----------------
+
+COL_TS_IDX = 0  # which column contains timestamps, starting from 0
+COL_CHAN_IDX = 1
+COL_VAL_IDX = 2
+
+HZ = 250 * 1000*1000  # ts = time * HZ
+KNOT = 3600  # sec, a distance between spline knots
+DEGREE = 3
+
+# -----------------------------------------
+
+
+class DriftModel(object):
+    """ Spline per channel: value(ts).
+        The gain factor is value(ts) / value at the first timestamp
+        (like in monsys_adjust.py).
+    """
+    def __init__(self, splines):
+        self.splines = splines  # {chan: (t, c, k, ts_min, ts_max)}
+
+    def values(self, chan, ts):
+        t, c, k, ts_min, ts_max = self.splines[chan]
+        x = (np.clip(ts, ts_min, ts_max) - ts_min) / HZ
+        return splev(x, (t, c, int(k)))
+
+    def factors(self, ts, chans):
+        """ Return gain factors for records (`ts`, `chans`),
+            NaN for channels without a model.
+        """
+        ret = np.full(len(ts), np.nan)
+        for chan in np.unique(chans):
+            if chan not in self.splines:
+                continue
+            sel = chans == chan
+            ref = self.values(chan, self.splines[chan][3])
+            ret[sel] = self.values(chan, ts[sel]) / ref
+        return ret
+
+    def save(self, filename):
+        arrays = {}
+        for chan, (t, c, k, ts_min, ts_max) in self.splines.items():
+            arrays['t_{}'.format(chan)] = t
+            arrays['c_{}'.format(chan)] = c
+            arrays['p_{}'.format(chan)] = np.array([k, ts_min, ts_max])
+        np.savez_compressed(filename, **arrays)
+
+
+def load_model(filename):
+    """ Load DriftModel from .npz file. """
+    splines = {}
+    with np.load(filename) as npz:
+        for key in npz.files:
+            if not key.startswith('p_'):
+                continue
+            name = key[2:]
+            k, ts_min, ts_max = npz[key]
+            chan = int(name) if name.lstrip('-').isdigit() else name
+            splines[chan] = (npz['t_' + name], npz['c_' + name], k, ts_min, ts_max)
+    return DriftModel(splines)
+
+
+def fit_spline(ts, vals, knot=KNOT, degree=DEGREE):
+    """ Least squares spline for one channel, `ts` are sorted.
+        Return (t, c, k, ts_min, ts_max).
+    """
+    x = (ts - ts[0]) / HZ
+    nknots = int(x[-1] // knot)
+    # interior knots at quantiles, so there are points between knots
+    knots = np.unique(np.percentile(x, np.linspace(0, 100, nknots + 2)[1:-1]))
+    knots = knots[(knots > x[0]) & (knots < x[-1])]
+
+    t, c, k = splrep(x, vals, k=degree, t=knots, task=-1)
+    return t, c, k, ts[0], ts[-1]
+
+
+def fit_model(filename, knot=KNOT):
+    loaded = pd.read_csv(filename, delim_whitespace=True, header=None,
+            comment='#', usecols=(COL_TS_IDX, COL_CHAN_IDX, COL_VAL_IDX))
+
+    splines = {}
+    for chan, group in loaded.groupby(COL_CHAN_IDX):
+        group = group.drop_duplicates(COL_TS_IDX).sort_values(COL_TS_IDX)
+        ts = group[COL_TS_IDX].values.astype(float)
+        vals = group[COL_VAL_IDX].values.astype(float)
+        if len(ts) <= DEGREE:
+            sys.stderr.write("chan {}: not enough points\n".format(chan))
+            continue
+        splines[chan] = fit_spline(ts, vals, knot)
+
+    return DriftModel(splines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('infile', help='monitoring data (output of monsys_avg.py)')
+
+    parser.add_argument('-o', '--output', required=True,
+            metavar='FILE.npz',
+            help='a file for the model')
+
+    parser.add_argument('-k', '--knot', type=float, default=KNOT,
+            metavar='SEC',
+            help='a distance between spline knots (%d sec by default)' % KNOT)
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.infile):
+        sys.stderr.write("No such file: '%s'\n" % args.infile)
+        exit(1)
+
+    model = fit_model(args.infile, args.knot)
+    model.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,19 @@
 # -*- coding: utf-8 -*-
 """
 Average datapoints.
+
+Reduce monitoring data to a given number of points per channel.
+Points of each channel are grouped into equal time buckets:
+  mean -- average timestamps, values and std in each bucket;
+  lttb -- select one point per bucket with the Largest-Triangle-Three-Buckets
+          algorithm (preserves peaks and drift features, for plotting).
 """
 
 import sys
 import os
+import argparse
 import numpy as np
+import pandas as pd
 
 
 # ------------ Parameters -----------------
@@ -18,39 +26,121 @@ COL_STD_IDX = 3
 
 DATAPOINTS = 100
 
+OUT_FORMAT = '%.0f %d %.2f %.2f'  # ts chan val std
+
 # -----------------------------------------
 
-if len(sys.argv) != 2:
-    sys.stderr.write("USAGE: %s <data.txt>\n" % sys.argv[0])
-    exit(1)
 
-filename = sys.argv[1]
-if not os.path.isfile(filename):
-    sys.stderr.write("No such file: '%s'\n" % filename)
-    exit(1)
-    
-dtype = np.dtype({
-        'names': ['ts', 'chan', 'val', 'std'],
-        'formats' : ['float', 'int', 'f','f'],
-        })
+def time_buckets(ts, npoints):
+    """ Return a bucket index for each timestamp (`ts` are sorted):
+        `npoints` equal time intervals from the first to the last ts.
+    """
+    edges = np.linspace(ts[0], ts[-1], npoints + 1)
+    return np.clip(np.searchsorted(edges, ts, side='right') - 1, 0, npoints - 1)
+
+
+def reduce_mean(ts, val, std, npoints):
+    """ Average points in each time bucket (empty buckets are skipped). """
+    idx = time_buckets(ts, npoints)
+    counts = np.bincount(idx, minlength=npoints)
+    nonempty = counts > 0
+    counts = counts[nonempty]
+
+    def avg(x):
+        return np.bincount(idx, x, minlength=npoints)[nonempty] / counts
+
+    return avg(ts), avg(val), avg(std)
+
+
+def reduce_lttb(ts, val, std, npoints):
+    """ Largest-Triangle-Three-Buckets downsampling:
+        the first and the last points are kept, one point is selected
+        in each of `npoints` - 2 time buckets between them.
+    """
+    if len(ts) <= npoints or npoints < 3:
+        return ts, val, std
+
+    idx = time_buckets(ts[1:-1], npoints - 2) + 1
+    starts = np.searchsorted(idx, np.arange(1, npoints - 1)) + 1
+    ends = np.append(starts[1:], len(ts) - 1)
+
+    # the next bucket averages (the last point for the last bucket)
+    csum_ts = np.concatenate(([0], np.cumsum(ts - ts[0])))
+    csum_val = np.concatenate(([0], np.cumsum(val)))
+    nxt_starts = np.append(starts[1:], len(ts) - 1)
+    nxt_ends = np.append(ends[1:], len(ts))
+    nxt_n = np.maximum(nxt_ends - nxt_starts, 1)
+    avg_ts = (csum_ts[nxt_ends] - csum_ts[nxt_starts]) / nxt_n + ts[0]
+    avg_val = (csum_val[nxt_ends] - csum_val[nxt_starts]) / nxt_n
+
+    # empty next bucket -> the first non-empty one after it
+    nb = len(nxt_n)
+    pos = np.where(nxt_ends > nxt_starts, np.arange(nb), nb - 1)
+    pos = np.minimum.accumulate(pos[::-1])[::-1]
+    avg_ts, avg_val = avg_ts[pos], avg_val[pos]
+
+    selected = [0]
+    for b in range(len(starts)):
+        s, e = starts[b], ends[b]
+        if s >= e:
+            continue  # empty bucket
+        a = selected[-1]
+        area = np.abs((ts[a] - avg_ts[b]) * (val[s:e] - val[a])
+                - (ts[a] - ts[s:e]) * (avg_val[b] - val[a]))
+        selected.append(s + area.argmax())
+    selected.append(len(ts) - 1)
+
+    return ts[selected], val[selected], std[selected]
+
+
+REDUCERS = {
+    'mean': reduce_mean,
+    'lttb': reduce_lttb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('infile', help='monitoring data (output of monsys_avg.py)')
+
+    parser.add_argument('-n', '--points',
+            type=int,
+            default=DATAPOINTS,
+            help='a number of points per channel (%d by default)' % DATAPOINTS
+            )
+
+    parser.add_argument('-m', '--mode',
+            choices=sorted(REDUCERS),
+            default='mean',
+            help="'mean' (default) or 'lttb' (for plotting)"
+            )
+
+    args = parser.parse_args()
+
+    filename = args.infile
+    if not os.path.isfile(filename):
+        sys.stderr.write("No such file: '%s'\n" % filename)
+        exit(1)
 
-usecols = (COL_TS_IDX, COL_CHAN_IDX, COL_VAL_IDX, COL_STD_IDX)
-loaded = np.loadtxt(filename, dtype = dtype, usecols=usecols)
+    usecols = (COL_TS_IDX, COL_CHAN_IDX, COL_VAL_IDX, COL_STD_IDX)
+    loaded = pd.read_csv(filename, delim_whitespace=True, header=None,
+            comment='#', usecols=usecols)
 
-chans =  np.unique(loaded['chan'])
+    reducer = REDUCERS[args.mode]
 
-chunklen = len(loaded)/ len(chans) / DATAPOINTS  # assume same amount of data in all channels
+    for chan, group in loaded.groupby(COL_CHAN_IDX):
+        group = group.sort_values(COL_TS_IDX)
+        ts = group[COL_TS_IDX].values.astype(float)
+        val = group[COL_VAL_IDX].values.astype(float)
+        std = group[COL_STD_IDX].values.astype(float)
 
+        ts, val, std = reducer(ts, val, std, args.points)
 
-data = dict( (c, []) for c in chans)
-stddata = dict( (c, []) for c in chans)
+        out = np.column_stack((ts, np.full(len(ts), chan), val, std))
+        np.savetxt(sys.stdout, out, fmt=OUT_FORMAT)
 
-for x in loaded:    
-    ts, chan, val, std = x['ts'], x['chan'],x['val'], x['std']
-    data[chan].append(val)
-    stddata[chan].append(std)
 
-    if len(data[chan]) >= chunklen:
-        print '{:.0f} {} {:.2f} {:.2f}'.format(ts, chan, np.average(data[chan]), np.average(stddata[chan]))
-        data[chan] = []
-        stddata[chan] = []
+if __name__ == "__main__":
+    main()
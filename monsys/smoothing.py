@@ -0,0 +1,214 @@
+"""
+Streaming smoothing of monitoring data, for all channels at once.
+
+Each filter keeps a state per channel: update(chan, val) adds a value
+and returns the smoothed one. It costs O(1) per value for the mean and
+EWMA; the median and the trimmed mean keep the window in a sorted list,
+the position is found by bisection, but insertion and removal move the
+list items, so an update is O(window) (a memmove, fast for windows of
+monitoring points).
+"""
+
+from bisect import bisect_left
+from collections import deque
+
+import numpy as np
+
+METHODS = ('mean', 'ewma', 'median')
+
+
+class RollingMean(object):
+    """ Mean of the last `window` values (a ring buffer with a running sum).
+    """
+    def __init__(self, window):
+        self.window = window
+        self.buf = {}  # chan: ring buffer
+        self.pos = {}  # chan: next position in the buffer
+        self.count = {}
+        self.summ = {}
+
+    def update(self, chan, val):
+        if chan not in self.buf:
+            self.buf[chan] = np.zeros(self.window)
+            self.pos[chan] = 0
+            self.count[chan] = 0
+            self.summ[chan] = 0.0
+
+        buf, pos = self.buf[chan], self.pos[chan]
+
+        self.summ[chan] += val - buf[pos]
+        buf[pos] = val
+        self.pos[chan] = (pos + 1) % self.window
+        self.count[chan] = min(self.count[chan] + 1, self.window)
+
+        if self.pos[chan] == 0:  # recalculate to avoid rounding errors
+            self.summ[chan] = buf.sum()
+
+        return self.summ[chan] / self.count[chan]
+
+
+class Ewma(object):
+    """ Exponentially weighted moving average,
+        `alpha` = 2 / (window + 1).
+    """
+    def __init__(self, window):
+        self.alpha = 2.0 / (window + 1)
+        self.mean = {}
+
+    def update(self, chan, val):
+        if chan not in self.mean:
+            self.mean[chan] = float(val)
+        else:
+            self.mean[chan] += self.alpha * (val - self.mean[chan])
+        return self.mean[chan]
+
+
+class SortedWindow(object):
+    """ The last values of one channel, in order of arrival and sorted
+        (O(window) per value, see above).
+    """
+    def __init__(self):
+        self.fifo = deque()  # values in order of arrival
+        self.sorted = []  # the same values, sorted
+
+    def __len__(self):
+        return len(self.fifo)
+
+    def push(self, val):
+        """ Add a value, return its index in the sorted list. """
+        idx = bisect_left(self.sorted, val)
+        self.sorted.insert(idx, val)
+        self.fifo.append(val)
+        return idx
+
+    def pop(self):
+        """ Remove the oldest value, return it and its index
+            in the sorted list before the removal.
+        """
+        val = self.fifo.popleft()
+        idx = bisect_left(self.sorted, val)
+        del self.sorted[idx]
+        return val, idx
+
+
+class RollingMedian(object):
+    """ Median of the last `window` values.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.windows = {}  # chan: SortedWindow
+
+    def update(self, chan, val):
+        if chan not in self.windows:
+            self.windows[chan] = SortedWindow()
+
+        win = self.windows[chan]
+        win.push(val)
+        if len(win) > self.window:
+            win.pop()
+
+        srt = win.sorted
+        n = len(srt)
+        if n % 2:
+            return srt[n // 2]
+        return (srt[n // 2 - 1] + srt[n // 2]) / 2.0
+
+
+class RollingTrimmedMean(object):
+    """ Mean of the last `window` values without `trim` percent
+        of the lowest and the highest ones.
+
+        The sum of the inner values is kept: a new or a dropped value
+        changes it by itself if it lands between the trim boundaries,
+        otherwise by the value that crosses the boundary. The sum is
+        recomputed every `window` values, so rounding errors do not add up.
+    """
+    def __init__(self, window, trim=10):
+        if not 0 <= trim < 50:
+            raise ValueError("trim is a percent in [0, 50), but {} given".format(trim))
+        self.window = window
+        self.trim = trim
+        self.windows = {}  # chan: SortedWindow
+        self.summ = {}  # chan: sum of the inner values of a full window
+        self.count = {}  # chan: values since the sum was recomputed
+
+    def update(self, chan, val):
+        if chan not in self.windows:
+            self.windows[chan] = SortedWindow()
+            self.count[chan] = 0
+
+        win = self.windows[chan]
+        srt = win.sorted
+        n = self.window
+        k = n * self.trim // 100
+
+        if chan not in self.summ:
+            win.push(val)
+            skip = len(srt) * self.trim // 100
+            inner = srt[skip:len(srt) - skip]
+            if len(srt) == n:
+                self.summ[chan] = sum(inner)
+            return sum(inner) / float(len(inner))
+
+        summ = self.summ[chan]
+
+        # inner values are [k, n + 1 - k) of the n + 1 values
+        idx = win.push(val)
+        if idx < k:
+            summ += srt[k]
+        elif idx > n - k:
+            summ += srt[n - k]
+        else:
+            summ += val
+
+        # and [k, n - k) after the oldest one is dropped
+        old, idx = win.pop()
+        if idx < k:
+            summ -= srt[k - 1]
+        elif idx > n - k:
+            summ -= srt[n - k]
+        else:
+            summ -= old
+
+        self.count[chan] += 1
+        if self.count[chan] >= n:
+            self.count[chan] = 0
+            summ = sum(srt[k:n - k])
+
+        self.summ[chan] = summ
+        return summ / float(n - 2 * k)
+
+
+def make_smoother(method, window):
+    """ Return a smoother for `method` (one of METHODS). """
+    if method == 'mean':
+        return RollingMean(window)
+    if method == 'ewma':
+        return Ewma(window)
+    if method == 'median':
+        return RollingMedian(window)
+    raise ValueError("method is one of {}, but '{}' given".format(METHODS, method))
+
+
+def smooth_array(vals, method, window):
+    """ Smooth an array of values of one channel,
+        the same as feeding them to make_smoother(method, window).
+    """
+    vals = np.asarray(vals, dtype=float)
+    if not len(vals):
+        return vals
+
+    if method == 'mean':
+        csum = np.cumsum(np.concatenate(([0.0], vals)))
+        idx = np.arange(1, len(vals) + 1)
+        start = np.maximum(idx - window, 0)
+        return (csum[idx] - csum[start]) / (idx - start)
+
+    if method == 'ewma':
+        from scipy.signal import lfilter
+        alpha = 2.0 / (window + 1)
+        ret, _ = lfilter([alpha], [1, alpha - 1], vals, zi=[(1 - alpha) * vals[0]])
+        return ret
+
+    smoother = make_smoother(method, window)
+    return np.array([smoother.update(None, v) for v in vals])
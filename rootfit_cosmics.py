@@ -13,14 +13,19 @@ import sys
 import os
 import signal
 import argparse
+import multiprocessing
 from itertools import cycle  # cycle facecolors
 from itertools import chain
 from collections import defaultdict
 
 import logging
 import numpy as np
+from array import array
     
+from langaus import langaus_exp
+from fitstore import FitStore
 from util import common_start
+from util import movingaverage
 from util import natural_keys
 from util import makedirs
 
@@ -97,7 +102,8 @@ def parse_args():
     parser.add_argument( 'params',
             type = parse_fit_params,
             metavar = 'P1,P2,..P6', 
-            help = 'initial fit parameters for langaus()',
+            help = 'initial fit parameters for langaus()'
+                ' or "auto" to estimate them for each histogram',
             )
 
     parser.add_argument( '-c','--chan',
@@ -119,12 +125,57 @@ def parse_args():
             help = 'set a number of bins'
             )
 
+    parser.add_argument('-u', '--unbinned',
+            action='store_true',
+            help="unbinned maximum likelihood fit of raw values"
+                " (histogram is used only for drawing)"
+            )
+
+    parser.add_argument('--bootstrap',
+            type = int,
+            default = 0,
+            metavar = 'N',
+            help = 'estimate MPL uncertainty with N bootstrap replicas'
+                ' of the histogram (binned fit)'
+            )
+
+    parser.add_argument('-j', '--jobs',
+            type = int,
+            default = multiprocessing.cpu_count(),
+            help = 'a number of processes for --bootstrap'
+                ' (number of CPUs by default)'
+            )
+
+    parser.add_argument('-s', '--store',
+            type=str,
+            metavar='FILE',
+            help="save fit results to a SQLite file"
+            )
+
+    parser.add_argument('-w', '--warm-start',
+            action='store_true',
+            help="take initial parameters from the fit of the nearest"
+                " previous run of the same channel and trigger in --store"
+            )
+
     parser.add_argument('-o','--output',
             type=str,
             metavar='PATH',
             help="a path for output, one file per channel."
             )
 
+    parser.add_argument('-f','--format',
+            type = parse_formats,
+            default = ['png'],
+            metavar = 'LIST',
+            help="output file formats (separated by commas, 'png' by default)"
+            )
+
+    parser.add_argument('--batch',
+            action='store_true',
+            help="do not show plots, just save them to --output"
+            )
+
     parser.add_argument('-q','--quiet',
             action='store_true',
             help="minimize output to stderr"
@@ -137,6 +188,9 @@ def parse_args():
 
     args = parser.parse_args()
 
+    if args.warm_start and not args.store:
+        parser.error("--warm-start requires --store")
+
     if args.debug:
         print_err(args)
 
@@ -147,7 +201,14 @@ def parse_chans(value):
     return value.split(',')
 
 
+def parse_formats(value):
+    return value.split(',')
+
+
 def parse_fit_params(value):
+    if value == 'auto':
+        return None, []
+
     sparams = value.split(',')
     if len(sparams) != 6:
         raise argparse.ArgumentTypeError(
@@ -182,12 +243,17 @@ def main():
     
     args = parse_args()
 
+    if args.batch:
+        ROOT.gROOT.SetBatch(True)
+        if args.quiet:
+            ROOT.gErrorIgnoreLevel = ROOT.kWarning  # no 'file has been created'
+
     labels = [f.name for f in args.infiles]
     common_label = common_start(*labels)
     shortlabels = [l[len(common_label):] for l in labels]
         
     if args.output:
-        makedirs(args.output)
+        makedirs(os.path.join(args.output, ''))
 
     if not args.quiet:
         print_err('channels: {}', str(args.chan) )
@@ -196,6 +262,9 @@ def main():
             print_err(LANGAUS_FUNC)
         print_err(LANGAUS_NAMES)
 
+    store = FitStore(args.store) if args.store else None
+    pool = multiprocessing.Pool(args.jobs) if args.bootstrap else None
+
     # 
     data = defaultdict(dict)
 
@@ -219,8 +288,8 @@ def main():
             continue
 
         title = "Chan {} ({})".format(chan, common_label)
-        outfile = "./{}/{}.png".format(args.output, chan) \
-                if args.output else None
+        outfiles = [os.path.join(args.output, "{}.{}".format(chan, ext))
+                for ext in args.format] if args.output else []
         
         hists = {}
     
@@ -228,6 +297,14 @@ def main():
         
         fit_params, fit_fixed = args.params
 
+        if fit_params is None:  # auto
+            allrange = auto_range(np.concatenate(cdata.values()))
+            if not _range:
+                _range = allrange
+
+            if len(_range) == 1:
+                _range = (_range[0], allrange[1])
+
         if not _range:
             _range = (0, fit_params[1] * 2)
 
@@ -245,15 +322,56 @@ def main():
         fitresults = {}
 
         for k in sorted(hists):
-            fitfunc, fitres = langaus_fit(hists[k], 
+            params = fit_params
+
+            prev = store.previous(common_label, chan, k) \
+                    if args.warm_start else None
+            if prev:
+                params = [fit_params[i] if i in fit_fixed else p
+                        for i, p in enumerate(prev)]
+                if args.debug:
+                    print_err('{} warm start: {}', k,
+                        ' '.join(['{:.2f}'.format(p) for p in params]))
+
+            if params is None:
+                try:
+                    params = auto_params(cdata[k], _range, args.bins)
+                except ValueError as e:
+                    print_err('chan {} {}: {}, skipped', chan, k, e)
+                    continue
+                if args.debug:
+                    print_err('{} auto params: {}', k,
+                        ' '.join(['{:.2f}'.format(p) for p in params]))
+
+            if args.unbinned:
+                vals = cdata[k]
+                nvals = np.count_nonzero((vals >= _range[0]) & (vals < _range[1]))
+                binwidth = hists[k].GetBinWidth(1)
+                fitfunc, fitres = langaus_fit_unbinned(vals,
                                         fitrange,
-                                        fit_params,
+                                        params,
+                                        fixed=fit_fixed,
+                                        scale=nvals/binwidth,
+                                        binwidth=binwidth,
+                                        verbose = args.debug)
+            else:
+                fitfunc, fitres = langaus_fit(hists[k], 
+                                        fitrange,
+                                        params,
                                         fixed=fit_fixed,
                                         verbose = args.debug)
 
             fitfuncs[k] = fitfunc
             fitresults[k] = fitres
             strparams = ' '.join( ['{:.2f}'.format(p) for p in fitres.Parameters()] )
+
+            if pool:
+                boot = bootstrap_mpl(pool, cdata[k], args.bins, _range,
+                        fitrange, list(fitres.Parameters()), fit_fixed,
+                        args.bootstrap)
+                strparams += '\tboot {:.2f} -{:.2f} +{:.2f}'.format(
+                        boot[1], boot[1] - boot[0], boot[2] - boot[1])
+
             print '{} chan {}\t {}\tMPL {:.2f} ' \
                     '±{:.2f}\tchi2 {:.2f}\tndf {:.2f}\tparams {}' \
                     ''.format(
@@ -266,21 +384,48 @@ def main():
                             fitres.Ndf(),
                             strparams
                         )
-            if args.debug:
-                pass
+            if store:
+                store.save(common_label, chan, k, fitres)
         
-        root_plot(hists, fitfuncs, outfile=outfile, title=title)
+        if args.batch and not outfiles:
+            continue  # nothing to draw
+
+        root_plot(hists, fitfuncs, outfiles=outfiles, title=title,
+                batch=args.batch)
+
+    if pool:
+        pool.close()
+        pool.join()
             
 
-def root_plot(hists, fitfuncs={}, outfile=None, title=''):
+_canvas = None
+
+
+def get_canvas(title=''):
+    """ Return the same canvas for every plot (in batch mode). """
+    global _canvas
+    if _canvas is None:
+        _canvas = ROOT.TCanvas('c1', str(title) , 200, 10, 700, 500 )
+    _canvas.Clear()
+    _canvas.SetTitle(str(title))
+    return _canvas
+
+
+def root_plot(hists, fitfuncs={}, outfiles=[], title='', batch=False):
+    """ Draw histograms with fit functions, save the canvas to `outfiles`.
+        If not `batch`, wait until the canvas is closed.
+    """
     if not hists:
         print_err('No hists to plot')
         return
 
     single = len(hists) is 1
 
-    ROOT.gROOT.Reset()
-    c1 = ROOT.TCanvas('c1', str(title) , 200, 10, 700, 500 )
+    if batch:
+        c1 = get_canvas(title)
+    else:
+        ROOT.gROOT.Reset()
+        c1 = ROOT.TCanvas('c1', str(title) , 200, 10, 700, 500 )
     c1.SetGrid()
     legend = ROOT.TLegend(0.5, 0.8, 0.9,0.9)
     
@@ -294,6 +439,7 @@ def root_plot(hists, fitfuncs={}, outfile=None, title=''):
         hist.SetLineColor(hist_color);
         
         if idx == 0:
+            hist.SetTitle(str(title))
             hist.Draw('HIST')
         else:
             hist.Draw('HIST SAMES')
@@ -311,7 +457,12 @@ def root_plot(hists, fitfuncs={}, outfile=None, title=''):
         legend.Draw()
         
     c1.Update()
-    wait(True)
+
+    for fn in outfiles:
+        c1.SaveAs(fn)
+
+    if not batch:
+        wait(True)
 
 def hist_idx(start=0):
     idx = start
@@ -372,6 +523,61 @@ def auto_range(data):
     return _range
     
 
+AUTO_SMOOTH = 5  # bins, a window to smooth the histogram for auto_params()
+
+def auto_params(data, range_, nbins):
+    """ Estimate initial langaus fit parameters for the histogram
+        of `data` with robust statistics.
+
+        MPL -- the highest local maximum of the smoothed histogram;
+        widths -- from quantiles of values above MPL/2;
+        area -- from the integral above MPL/2;
+        exponent -- from the low-amplitude tail (below MPL/2).
+
+        Return a list of parameters (see LANGAUS_NAMES).
+    """
+    data = np.asarray(data)
+    counts, edges = np.histogram(data, bins=nbins, range=range_)
+    binwidth = edges[1] - edges[0]
+    centers = (edges[:-1] + edges[1:]) / 2
+    total = counts.sum()
+    if not total:
+        raise ValueError("no data in range {}".format(range_))
+
+    frac = counts * 1.0 / total  # like normalized ROOT histogram
+    smoothed = movingaverage(frac, AUTO_SMOOTH)
+
+    # local maxima, except the edges distorted by smoothing
+    edge = AUTO_SMOOTH // 2 + 1
+    inner = smoothed[edge:-edge]
+    maxima = np.where((inner > smoothed[edge-1:-edge-1])
+                & (inner >= smoothed[edge+1:len(smoothed)-edge+1]))[0] + edge
+    if len(maxima):
+        peak = maxima[smoothed[maxima].argmax()]
+    else:
+        peak = smoothed.argmax()
+    mpl = centers[peak]
+
+    core = data[(data > mpl / 2) & (data < range_[1])]
+    if len(core) < 4:
+        core = data
+    q10, q25, q50, q75 = np.percentile(core, [10, 25, 50, 75])
+    width = max((q75 - q25) / 5, binwidth / 2)
+    sigma = max((q50 - q10) / 2, binwidth / 2)
+    area = binwidth * len(core) / total
+
+    # exponential background: log-linear fit of the low-amplitude tail
+    exp_a, exp_b = 0.0, 0.0
+    tail = (centers < mpl / 2) & (counts > 0)
+    if np.count_nonzero(tail) >= 2:
+        slope, offset = np.polyfit(centers[tail], np.log(frac[tail]), 1)
+        if slope < 0:
+            exp_a = np.exp(offset) / 0.001
+            exp_b = -slope / 0.0001
+
+    return [width, mpl, area, sigma, exp_a, exp_b]
+
+
 def freedman_bin_width(data):
     """Return the optimal number of bins using the Freedman-Diaconis rule.
 
@@ -428,6 +634,171 @@ def langaus_fit(hist, fitrange, parameters, fixed=[], verbose=False):
     fitres = hist.Fit(fitfunc, fitopts )
     return fitfunc, fitres
 
+
+def _bootstrap_fit(task):
+    """ Fit one bootstrap replica (in a worker process), return MPL. """
+    counts, range_, fitrange, parameters, fixed = task
+
+    idx = next(_idx)
+    hist = ROOT.TH1F("boot"+str(idx), "boot"+str(idx),
+            len(counts), range_[0], range_[1])
+    for i, c in enumerate(counts):
+        hist.SetBinContent(i + 1, float(c))
+    hist.SetEntries(float(counts.sum()))
+
+    integral = hist.Integral()
+    if integral > 0:
+        hist.Scale(1/integral)
+
+    fitfunc, fitres = langaus_fit(hist, fitrange, parameters, fixed=fixed)
+    return fitres.Parameter(1) if fitres.Status() == 0 else np.nan
+
+
+BOOTSTRAP_PERCENTILES = (16, 50, 84)  # +-1 sigma for normal distribution
+
+def bootstrap_mpl(pool, vals, nbins, range_, fitrange, parameters, fixed, nrep):
+    """ Poisson resampling of histogram bin counts, refit each replica
+        in the `pool` of processes.
+
+        Return BOOTSTRAP_PERCENTILES of MPL.
+    """
+    counts, _ = np.histogram(vals, bins=nbins, range=range_)
+    replicas = np.random.poisson(counts, size=(nrep, len(counts)))
+
+    tasks = [(r, range_, fitrange, parameters, fixed) for r in replicas]
+    mpls = np.array(pool.map(_bootstrap_fit, tasks))
+    mpls = mpls[np.isfinite(mpls)]
+    if not len(mpls):
+        return [np.nan] * len(BOOTSTRAP_PERCENTILES)
+
+    return np.percentile(mpls, BOOTSTRAP_PERCENTILES)
+
+
+UNBINNED_NPX = 500  # points to tabulate the model in the fit range
+UNBINNED_MAXCALLS = 5000
+
+
+class UnbinnedFitResult(object):
+    """ Mimics TFitResult methods used in this script.
+    """
+    def __init__(self, params, errors, cov, chi2, ndf, status, ncalls):
+        self.params = params
+        self.errors = errors
+        self.cov = cov
+        self.chi2 = chi2
+        self.ndf = ndf
+        self.status = status
+        self.ncalls = ncalls
+
+    def Parameters(self):
+        return self.params
+
+    def Parameter(self, idx):
+        return self.params[idx]
+
+    def ParError(self, idx):
+        return self.errors[idx]
+
+    def CovMatrix(self, i, j):
+        return self.cov[i][j]
+
+    def Chi2(self):
+        return self.chi2
+
+    def Ndf(self):
+        return self.ndf
+
+    def Status(self):
+        return self.status
+
+    def NCalls(self):
+        return self.ncalls
+
+
+def langaus_fit_unbinned(vals, fitrange, parameters, fixed=[], scale=1.0,
+        binwidth=1.0, verbose=False):
+    """ Fit raw values with langauss + exponential noize
+        (extended unbinned maximum likelihood, MIGRAD).
+
+        The model is the same as in `langaus_fit`; `scale` converts it
+        to the density of events (number of events / bin width),
+        so the parameters are the same as in the binned fit.
+        Chi2 is calculated for the bins of `binwidth` in the fit range.
+
+        The model is tabulated on a grid in the fit range and
+        linearly interpolated for each event.
+
+        Return the fit function and a fit result object.
+    """
+    fitXmin, fitXmax = fitrange
+    vals = np.asarray(vals, dtype=float)
+    vals = vals[(vals >= fitXmin) & (vals <= fitXmax)]
+
+    grid = np.linspace(fitXmin, fitXmax, UNBINNED_NPX)
+    gstep = grid[1] - grid[0]
+    pos = (vals - fitXmin) / gstep
+    idx = np.minimum(pos.astype(int), UNBINNED_NPX - 2)
+    frac = pos - idx
+
+    def nll(params):
+        tab = langaus_exp(grid, params)
+        integral = scale * np.trapz(tab, dx=gstep)
+        density = scale * (tab[idx] * (1 - frac) + tab[idx + 1] * frac)
+        return integral - np.log(np.maximum(density, 1e-300)).sum()
+
+    def fcn(npar, gin, f, par, iflag):
+        f[0] = nll([par[i] for i in range(len(parameters))])
+
+    minuit = ROOT.TMinuit(len(parameters))
+    minuit.SetPrintLevel(1 if verbose else -1)
+    minuit.SetFCN(fcn)
+
+    ierflg = ROOT.Long(0)
+    minuit.mnexcm("SET ERR", array('d', [0.5]), 1, ierflg)  # -log(L)
+
+    for i, (name, p) in enumerate(zip(LANGAUS_NAMES, parameters)):
+        step = abs(p) * 0.1 or 0.1
+        minuit.mnparm(i, name, p, step, 0, 0, ierflg)
+
+    for i in fixed:
+        minuit.FixParameter(i)
+
+    minuit.mnexcm("MIGRAD", array('d', [UNBINNED_MAXCALLS, 0.1]), 2, ierflg)
+    status = int(ierflg)
+
+    params, errors = [], []
+    for i in range(len(parameters)):
+        val, err = ROOT.Double(0), ROOT.Double(0)
+        minuit.GetParameter(i, val, err)
+        params.append(float(val))
+        errors.append(float(err))
+
+    # covariance matrix of free parameters -> for all parameters
+    npar = len(parameters)
+    free = [i for i in range(npar) if i not in fixed]
+    emat = array('d', [0.0] * (len(free) ** 2))
+    minuit.mnemat(emat, len(free))
+    cov = [[0.0] * npar for _ in range(npar)]
+    for a, i in enumerate(free):
+        for b, j in enumerate(free):
+            cov[i][j] = emat[a * len(free) + b]
+
+    # Chi2 (like in the binned fit) for goodness of fit
+    nbins = max(1, int(round((fitXmax - fitXmin) / binwidth)))
+    counts, edges = np.histogram(vals, bins=nbins, range=fitrange)
+    centers = (edges[:-1] + edges[1:]) / 2
+    expected = scale * binwidth * langaus_exp(centers, params)
+    nonzero = counts > 0
+    chi2 = (((counts - expected) ** 2)[nonzero] / counts[nonzero]).sum()
+    ndf = np.count_nonzero(nonzero) - (len(parameters) - len(fixed))
+
+    fitfunc = ROOT.TF1( 'fitfunc', LANGAUS_FUNC, fitXmin, fitXmax )
+    fitfunc.SetParNames(*LANGAUS_NAMES)
+    fitfunc.SetParameters(*params)
+
+    fitres = UnbinnedFitResult(params, errors, cov, chi2, ndf, status, minuit.fNfcn)
+    return fitfunc, fitres
+
 if __name__ == "__main__":
     main()
 